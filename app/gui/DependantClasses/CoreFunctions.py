@@ -1,4 +1,5 @@
-import time, os, threading, sys, glob, inspect, math
+import time, os, threading, sys, glob, inspect, math, collections
+import numpy
 
 class Bunch( dict ):
 	"""
@@ -16,6 +17,69 @@ class Bunch( dict ):
 		else: self[ key ] = value
 	def _getAttributeNames( self ): return self.keys()
 
+class IndexedBunch( Bunch ):
+	"""
+	A Bunch whose keys are underscore-delimited specifiers, as in TkMPL.artists and
+	TkMPL.widgets, and which keeps an inverted index from each (lower-case) specifier
+	to the set of keys that contain it.  The index is updated as items are added and
+	deleted, so that Lookup() can answer a query with a few set intersections instead
+	of splitting and scanning every key.  Results are also memoized per tuple of terms,
+	until the next time a key is added or removed.
+	"""
+	def __init__( self, d=(), **kwargs ):
+		self.__dict__[ 'tokens' ] = {}
+		self.__dict__[ 'lookups' ] = {}
+		Bunch.__init__( self )
+		self.update( d, **kwargs )
+	def __setitem__( self, key, value ):
+		if key not in self: self._Index( key )
+		dict.__setitem__( self, key, value )
+	def __delitem__( self, key ):
+		dict.__delitem__( self, key )
+		self._Unindex( key )
+	def update( self, d=(), **kwargs ):
+		for key, value in dict( d, **kwargs ).items(): self[ key ] = value
+		return self
+	def setdefault( self, key, value=None ):
+		if key not in self: self[ key ] = value
+		return self[ key ]
+	def pop( self, key, *default ):
+		if key not in self: return dict.pop( self, key, *default )
+		value = self[ key ]; del self[ key ]; return value
+	def popitem( self ):
+		key, value = dict.popitem( self ); self._Unindex( key ); return key, value
+	def clear( self ):
+		dict.clear( self ); self.tokens.clear(); self.lookups.clear()
+
+	def _Index( self, key ):
+		for token in set( key.lower().split( '_' ) ): self.tokens.setdefault( token, set() ).add( key )
+		self.lookups.clear()
+	def _Unindex( self, key ):
+		for token in set( key.lower().split( '_' ) ):
+			keys = self.tokens.get( token )
+			if keys == None: continue
+			keys.discard( key )
+			if not keys: del self.tokens[ token ]
+		self.lookups.clear()
+
+	def Lookup( self, *terms ):
+		"""
+		Return a list of the keys that contain all of the *terms (case-insensitively) among
+		their underscore-delimited parts, in the same order as iterating over the Bunch
+		would give them.  With no terms, all keys are returned.
+		"""
+		keys = self.lookups.get( terms )
+		if keys == None:
+			if terms:
+				sets = [ self.tokens.get( term.lower(), () ) for term in terms ]
+				sets.sort( key=len )
+				hits = set( sets[ 0 ] )
+				for other in sets[ 1: ]: hits.intersection_update( other )
+				keys = [ key for key in self if key in hits ] if hits else []
+			else: keys = self.keys()
+			self.lookups[ terms ] = keys
+		return list( keys )
+
 
 def FixAspectRatio(widget, aspect_ratio=None, relx=0.5, rely=0.5, anchor='center'):
     """
@@ -225,16 +289,351 @@ def FormatWithUnits( value, context=None, units='', fmt='%+g', stripZeroSign=Tru
 	if appendUnits: s += prefix + units
 	return s
 
+TIMEBASE_CACHE = collections.OrderedDict()
+TIMEBASE_CACHE_SIZE = 32
+TIMEBASE_LOCK = threading.Lock()
+
 def TimeBase( values, fs, lookback ):
 	"""
-	Given a sequence of voltage <values> that make up an epoch, return a list of time
-	values (in seconds) against which to plot them, on the assumption that <fs> samples
-	are recorded per second and that the epoch starts <lookback> seconds before
-	nominal time 0.
+	Given a sequence of voltage <values> that make up an epoch, return a numpy array of
+	time values (in seconds) against which to plot them, on the assumption that <fs>
+	samples are recorded per second and that the epoch starts <lookback> seconds before
+	nominal time 0.  Instead of the <values> themselves, their number may be given.
+
+	Only the length of <values> matters, and every epoch of a run has the same length,
+	sampling rate and lookback, so the arrays are memoized on ( length, fs, lookback ):
+	the TIMEBASE_CACHE_SIZE most recently used ones are kept.  The same array is handed
+	to every caller, so it is returned read-only -- copy it if you need to change it.
 
 	Used in graphical rendering routines throughout the GUI, SettingsWindow and AnalysisWindow.
 	"""
-	return [ float( sample ) / fs - lookback for sample, value in enumerate( values ) ]
+	if isinstance( values, ( int, long, numpy.integer ) ): n = values
+	else: n = len( values )
+	key = ( n, float( fs ), float( lookback ) )
+	with TIMEBASE_LOCK:
+		t = TIMEBASE_CACHE.pop( key, None )
+		if t is None:
+			t = numpy.arange( key[ 0 ], dtype=numpy.float64 ) / key[ 1 ] - key[ 2 ]
+			t.flags.writeable = False
+			while len( TIMEBASE_CACHE ) >= TIMEBASE_CACHE_SIZE: TIMEBASE_CACHE.popitem( last=False )
+		TIMEBASE_CACHE[ key ] = t
+	return t
+
+def MinMaxDecimate( x, y, pixels, xlim=None ):
+	"""
+	Reduce a trace, defined by sample times <x> and values <y>, to at most 2 * <pixels>
+	points, for display on axes that are <pixels> wide, without losing its peaks:  the
+	samples are divided into <pixels> consecutive bins and only the minimum and the maximum
+	of each bin are kept, in their original order.  If <xlim> is given, samples outside
+	that range (except for the nearest one on either side) are discarded first, so that
+	zooming in reveals more detail.  Traces that are already short enough are returned
+	whole.  Returns two numpy arrays.
+
+	<y> may also be a two-dimensional array of several traces (one per row) that share
+	the same sample times <x>, in which case they are all decimated in one go and both
+	of the returned arrays have one row per trace.
+	"""
+	x = numpy.asarray( x, dtype=numpy.float64 )
+	y = numpy.asarray( y, dtype=numpy.float64 )
+	if xlim != None and len( x ):
+		start = max( x.searchsorted( min( xlim ), side='right' ) - 1, 0 )
+		stop = min( x.searchsorted( max( xlim ), side='left' ) + 1, len( x ) )
+		x, y = x[ start:stop ], y[ ..., start:stop ]
+	pixels = max( int( pixels ), 1 )
+	n = y.shape[ -1 ]
+	if n <= 2 * pixels:
+		if y.ndim > 1: x = numpy.tile( x, ( len( y ), 1 ) )
+		return x, y
+	rows = y.reshape( -1, n )
+	size = int( math.ceil( n / float( pixels ) ) )
+	nBins = int( math.ceil( n / float( size ) ) )
+	bins = numpy.empty( ( len( rows ), nBins * size ), dtype=numpy.float64 )
+	bins[ :, :n ] = rows
+	bins[ :, n: ] = rows[ :, -1: ]
+	bins = bins.reshape( len( rows ), nBins, size )
+	offsets = numpy.arange( nBins ) * size
+	index = numpy.concatenate( ( offsets + bins.argmin( axis=2 ), offsets + bins.argmax( axis=2 ) ), axis=1 )
+	index = numpy.minimum( numpy.sort( index, axis=1 ), n - 1 )
+	values = rows[ numpy.arange( len( rows ) )[ :, None ], index ]
+	if y.ndim == 1: return x[ index[ 0 ] ], values[ 0 ]
+	return x[ index ], values
+
+class ScalarStore( object ):
+	"""
+	A growable, preallocated float64 store for a sequence of scalars that arrive one at
+	a time -- in practice, the one-value-per-SampleBlock data of a Voluntary Contraction
+	run.  append() costs O(1) (the buffer doubles in size whenever it fills up, so the
+	cost of copying is amortized) and the stored values, or the most recent of them,
+	are available as numpy views without copying.
+
+	The positions of the first and last non-zero values are tracked as values arrive,
+	so that trimmed() gives the same values as numpy.trim_zeros() would, at no cost.
+
+	For the benefit of existing code that expects a list, a ScalarStore also supports
+	len(), indexing, iteration, index() and numpy.asarray().
+
+	Note that a view reflects the buffer at the time it was taken: values appended
+	afterwards may or may not appear in it, depending on whether the buffer has had to
+	grow in the meantime. Treat views as read-only snapshots of the first len( view )
+	values.
+	"""
+	def __init__( self, values=(), capacity=4096 ):
+		self.buffer = numpy.zeros( ( max( int( capacity ), 1 ), ), dtype=numpy.float64 )
+		self.length = 0
+		self.firstNonZero = None
+		self.lastNonZero = None
+		self.extend( values )
+
+	def append( self, value ):
+		if self.length == self.buffer.size:
+			bigger = numpy.zeros( ( self.buffer.size * 2, ), dtype=numpy.float64 )
+			bigger[ :self.length ] = self.buffer[ :self.length ]
+			self.buffer = bigger
+		self.buffer[ self.length ] = value
+		if value != 0.0:
+			if self.firstNonZero == None: self.firstNonZero = self.length
+			self.lastNonZero = self.length
+		self.length += 1
+
+	def extend( self, values ):
+		if not isinstance( values, numpy.ndarray ):
+			for value in values: self.append( value )
+			return
+		values = values.ravel()
+		size = self.buffer.size
+		while size < self.length + values.size: size *= 2
+		if size > self.buffer.size:
+			bigger = numpy.zeros( ( size, ), dtype=numpy.float64 )
+			bigger[ :self.length ] = self.buffer[ :self.length ]
+			self.buffer = bigger
+		self.buffer[ self.length : self.length + values.size ] = values
+		nonZero = numpy.flatnonzero( values != 0.0 )
+		if len( nonZero ):
+			if self.firstNonZero == None: self.firstNonZero = self.length + int( nonZero[ 0 ] )
+			self.lastNonZero = self.length + int( nonZero[ -1 ] )
+		self.length += values.size
+
+	def values( self ):
+		"""
+		Return a view of all the stored values.
+		"""
+		return self.buffer[ :self.length ]
+
+	def tail( self, n ):
+		"""
+		Return a view of the last <n> stored values (or fewer, if fewer have been stored).
+		"""
+		return self.buffer[ max( self.length - int( n ), 0 ) : self.length ]
+
+	def trimmed( self ):
+		"""
+		Return a view of the stored values without any leading or trailing zeros.
+		"""
+		if self.firstNonZero == None: return self.buffer[ :0 ]
+		return self.buffer[ self.firstNonZero : self.lastNonZero + 1 ]
+
+	def index( self, value ):
+		matches = numpy.flatnonzero( self.values() == value )
+		if not len( matches ): raise ValueError( '%r is not in ScalarStore' % value )
+		return int( matches[ 0 ] )
+
+	def tolist( self ): return self.values().tolist()
+	def __len__( self ): return self.length
+	def __getitem__( self, index ): return self.values()[ index ]
+	def __iter__( self ): return iter( self.values() )
+	def __array__( self, dtype=None ):
+		if dtype == None: return self.values()
+		return self.values().astype( dtype )
+
+class TrialStore( object ):
+	"""
+	A growable, preallocated float64 store for EMG trials, each of which is a
+	channels-by-samples array, together with some per-trial metadata: the stimulation
+	<amplitude>, the <background> EMG magnitude and the index of the <run> that the
+	trial came from (an index into the list of labels in self.runs).
+	The trials are held in one contiguous trials-by-channels-by-samples array whose shape
+	is fixed by the first trial appended.  As with ScalarStore, append() costs O(1)
+	(amortized) and the stored trials are available as numpy views without copying:
+	values() gives all of them, channel() one channel of all of them, run() the trials of
+	one run, and indexing with an integer or a slice gives one trial or a range of them.
+
+	For the benefit of existing code that expects a list of trials, a TrialStore also
+	supports len(), indexing, iteration and numpy.asarray().  The views are read-only
+	(numpy refuses to write through them, since the stored trials must never change) and,
+	as with ScalarStore, they are snapshots of the trials stored so far.
+
+	Response magnitudes computed via magnitudes() are cached in the store (see there).
+	"""
+	magnitudeCacheSize = 64
+	windowIndexAfter = 4                   # number of distinct peak-to-peak windows queried on a channel before it gets a WindowIndex
+	windowIndexBytes = 128 * 1024 * 1024   # memory budget for the WindowIndex objects of all channels together
+
+	def __init__( self, trials=(), capacity=64, **metadata ):
+		self.capacity = max( int( capacity ), 1 )
+		self.buffer = None # allocated by the first append(), when the shape of a trial is known
+		self.length = 0
+		self.runs = []
+		self.metadata = Bunch(
+			amplitude  = numpy.zeros( ( self.capacity, ), dtype=numpy.float64 ) + numpy.nan,
+			background = numpy.zeros( ( self.capacity, ), dtype=numpy.float64 ) + numpy.nan,
+			run        = numpy.zeros( ( self.capacity, ), dtype=numpy.int32 ) - 1,
+		)
+		self.magnitudeCache = collections.OrderedDict()
+		self.windowQueries = {}
+		self.windowIndexes = collections.OrderedDict()
+		self.extend( trials, **metadata )
+
+	def grow( self ):
+		self.capacity *= 2
+		if self.buffer is not None:
+			bigger = numpy.zeros( ( self.capacity, ) + self.buffer.shape[ 1: ], dtype=numpy.float64 )
+			bigger[ :self.length ] = self.buffer[ :self.length ]
+			self.buffer = bigger
+		for field, values in self.metadata.items():
+			bigger = numpy.zeros( ( self.capacity, ), dtype=values.dtype )
+			bigger[ :self.length ] = values[ :self.length ]
+			self.metadata[ field ] = bigger
+
+	def append( self, trial, amplitude=numpy.nan, background=numpy.nan, run=None ):
+		"""
+		Append one <trial> (a channels-by-samples sequence or array), with its metadata.
+		"""
+		trial = numpy.asarray( trial, dtype=numpy.float64 )
+		if trial.ndim != 2: raise ValueError( 'a trial must be a channels-by-samples array (got shape %r)' % ( trial.shape, ) )
+		if self.buffer is None: self.buffer = numpy.zeros( ( self.capacity, ) + trial.shape, dtype=numpy.float64 )
+		elif trial.shape != self.buffer.shape[ 1: ]: raise ValueError( 'trial of shape %r cannot be stored with trials of shape %r' % ( trial.shape, self.buffer.shape[ 1: ] ) )
+		if self.length == self.capacity: self.grow()
+		if run != None and run not in self.runs: self.runs.append( run )
+		self.buffer[ self.length ] = trial
+		self.metadata.amplitude[ self.length ] = amplitude
+		self.metadata.background[ self.length ] = background
+		self.metadata.run[ self.length ] = -1 if run == None else self.runs.index( run )
+		self.length += 1
+
+	def extend( self, trials, **metadata ):
+		"""
+		Append each of the <trials>.  Each metadata keyword argument may be either a single
+		value that applies to all of them or a sequence of values, one per trial.
+		"""
+		for i, trial in enumerate( trials ):
+			self.append( trial, **dict( ( field, value[ i ] if numpy.ndim( value ) else value ) for field, value in metadata.items() ) )
+
+	def values( self ):
+		"""
+		Return a read-only view of all the stored trials, as a trials-by-channels-by-samples
+		array.
+		"""
+		if self.buffer is None: view = numpy.zeros( ( 0, 0, 0 ), dtype=numpy.float64 )
+		else: view = self.buffer[ :self.length ]
+		view.flags.writeable = False
+		return view
+
+	def channel( self, channel ):
+		"""
+		Return a (trials-by-samples) view of the specified <channel> of all the stored trials.
+		"""
+		return self.values()[ :, channel ]
+
+	def run( self, run ):
+		"""
+		Return the trials of the specified <run> (one of the labels in self.runs).  Since the
+		trials of a run are normally appended together, this is usually a view.
+		"""
+		index = numpy.flatnonzero( self.metadata.run[ :self.length ] == self.runs.index( run ) )
+		if len( index ) and index[ -1 ] - index[ 0 ] == len( index ) - 1: return self.values()[ index[ 0 ] : index[ -1 ] + 1 ]
+		return self.values()[ index ]
+
+	def take( self, indices ):
+		"""
+		Return a new TrialStore containing copies of the trials at the specified <indices>
+		(and their metadata), in the order given.
+		"""
+		indices = numpy.asarray( indices, dtype=int )
+		other = TrialStore( capacity=len( indices ) )
+		other.runs = list( self.runs )
+		if len( indices ) and self.buffer is not None: other.buffer = self.values()[ indices ]
+		for field, values in self.metadata.items(): other.metadata[ field ][ :len( indices ) ] = values[ :self.length ][ indices ]
+		other.length = len( indices )
+		return other
+
+	def magnitudes( self, channel, window, p2p=False ):
+		"""
+		Return a read-only view of the response magnitudes of all the stored trials,
+		computed by WindowMagnitudes() for the given <channel> and <window> (a slice, as
+		returned by WindowSlice()) as peak-to-peak (p2p=True) or mean rectified (p2p=False)
+		values.
+
+		The results are cached, keyed by channel, window and metric, so that only windows
+		that have not been seen before cost anything.  The trials themselves never change
+		once stored, so when trials have been appended since a cached entry was computed,
+		it is extended by the magnitudes of the new trials only.  Every entry covers all the
+		trials, whether or not they have been removed from the analysis:  leaving removed
+		trials out is up to the caller (e.g. ResponseSequence and ResponseDistribution, which
+		go by the emphasis of their ResponseOverlay), so it does not invalidate anything.  The
+		least recently used entries are discarded once there are more than
+		self.magnitudeCacheSize of them.
+
+		New peak-to-peak entries are computed with the help of a WindowIndex, if windowIndex()
+		provides one, so that trying out many different windows costs O(1) per trial each
+		time.  New mean rectified entries (the default metric) get no such help:  they are
+		always computed by WindowMagnitudes(), at a cost proportional to the window length,
+		so that they are exactly the same whatever the history of queries.  A shortcut via
+		cumulative sums can only be checked against rounding error where a value is compared
+		with a threshold (as in FirstChange() in StimulusControl), not where the values
+		themselves are returned, as here.  For mean rectified values, only repeated queries
+		of the same window are fast, through the cache.
+		"""
+		p2p = bool( p2p )
+		if not self.length: return numpy.zeros( ( 0, ), dtype=numpy.float64 )
+		start, stop, step = window.indices( self.buffer.shape[ -1 ] )
+		key = ( channel, start, stop, p2p )
+		cached = self.magnitudeCache.pop( key, None )
+		if cached == None:
+			cached = ScalarStore( capacity=self.capacity )
+			if p2p: index = self.windowIndex( channel )
+			else: index = None
+			if index != None: cached.extend( index.peakToPeak( window ) )
+		if len( cached ) < self.length: cached.extend( WindowMagnitudes( self.channel( channel )[ len( cached ): ], window, p2p=p2p ) )
+		self.magnitudeCache[ key ] = cached
+		while len( self.magnitudeCache ) > self.magnitudeCacheSize: self.magnitudeCache.popitem( last=False )
+		values = cached.values()
+		values.flags.writeable = False
+		return values
+
+	def windowIndex( self, channel ):
+		"""
+		Called by magnitudes() each time a new peak-to-peak window is queried for the given
+		<channel>.
+		Once self.windowIndexAfter windows have been queried, return a WindowIndex of the
+		channel's trials (otherwise return None).  The index is built lazily, and rebuilt
+		only when the number of trials appended since it was built exceeds half the number it
+		covers:  until then it is used for the trials it covers, and the rest are computed
+		directly.  Indexes of other channels are discarded, least recently used first, to
+		keep within self.windowIndexBytes;  if even that is not enough, None is returned.
+		"""
+		self.windowQueries[ channel ] = self.windowQueries.get( channel, 0 ) + 1
+		if self.windowQueries[ channel ] < self.windowIndexAfter: return None
+		index = self.windowIndexes.pop( channel, None )
+		if index == None or self.length - index.nTraces > index.nTraces // 2:
+			size = WindowIndex.EstimatedBytes( self.length, self.buffer.shape[ -1 ] )
+			if size > self.windowIndexBytes: index = None
+			else:
+				while len( self.windowIndexes ) and size + sum( other.nbytes for other in self.windowIndexes.values() ) > self.windowIndexBytes:
+					self.windowIndexes.popitem( last=False )
+				index = WindowIndex( self.channel( channel ) )
+		if index != None: self.windowIndexes[ channel ] = index
+		return index
+
+	amplitude  = property( lambda self: self.metadata.amplitude[ :self.length ] )
+	background = property( lambda self: self.metadata.background[ :self.length ] )
+
+	def tolist( self ): return self.values().tolist()
+	def __len__( self ): return self.length
+	def __getitem__( self, index ): return self.values()[ index ]
+	def __iter__( self ): return iter( self.values() )
+	def __array__( self, dtype=None ):
+		if dtype == None: return self.values()
+		return self.values().astype( dtype )
 
 class Monitor(object):
     x = 0
@@ -293,6 +692,124 @@ def get_monitors():
 	if chosen is None: raise NotImplementedError('This environment is not supported.')
 	return chosen.get_monitors()
 
+def WindowSlice( interval, fs, lookback, offset=1 ):
+	"""
+	Convert an <interval> of interest, specified by its endpoints in seconds relative to
+	nominal time 0, into a slice object that picks out the corresponding samples of an
+	epoch that was recorded at <fs> Hz starting <lookback> seconds before time 0.  The
+	rounding is the one that ResponseMagnitudes() has always used: the window starts at
+	sample round( ( start + lookback ) * fs ) + <offset> and is round( duration * fs )
+	samples long.  (The StimulusControl helpers have always used offset=0.)
+	"""
+	interval = min( interval ), max( interval )
+	start = int( round( ( interval[ 0 ] + lookback ) * fs ) ) + offset
+	length = int( round( ( interval[ 1 ] - interval[ 0 ] ) * fs ) )
+	return slice( max( start, 0 ), max( start + length, 0 ) )
+
+def WindowMagnitudes( traces, window, p2p=None ):
+	"""
+	Compute response magnitudes within the <window> (a slice, as returned by WindowSlice())
+	of each of the <traces>:  either a numpy array whose last dimension is time (e.g. a
+	trials-by-samples array, or a single trace) or a sequence of traces (e.g. lists, in
+	which case only the windows are copied).  Return the peak-to-peak values if p2p=True,
+	the mean rectified values if p2p=False, or both (as a tuple) if p2p=None, as numpy
+	arrays with one value per trace.
+
+	All the traces are reduced in one go.  The rectified values are accumulated in order,
+	sample by sample, so that the results are identical to those of a plain Python sum().
+	"""
+	if isinstance( traces, numpy.ndarray ): windows = traces[ ..., window ]
+	else: windows = [ trace[ window ] for trace in traces ]
+	try: windows = numpy.asarray( windows, dtype=float )
+	except ValueError: # traces of different lengths, some of which end within the window
+		results = [ WindowMagnitudes( numpy.asarray( w, dtype=float ), slice( None ), p2p=p2p ) for w in windows ]
+		if p2p == None: return tuple( numpy.array( x ) for x in zip( *results ) ) if results else ( numpy.zeros( 0 ), numpy.zeros( 0 ) )
+		return numpy.array( results )
+	if windows.shape[ -1 ] == 0: raise ValueError( 'no samples within the window %r' % window )
+	if p2p != False: peakToPeak = windows.max( axis=-1 ) - windows.min( axis=-1 )
+	if p2p != True: meanRectified = numpy.abs( windows ).cumsum( axis=-1 )[ ..., -1 ] / float( windows.shape[ -1 ] )
+	if p2p == True: return peakToPeak
+	if p2p == False: return meanRectified
+	return peakToPeak, meanRectified
+
+class WindowIndex( object ):
+	"""
+	An index over a trials-by-samples array of <traces> that answers peak-to-peak
+	WindowMagnitudes() queries in O(1) per trace, however long the window.  The minimum
+	and maximum come from a block decomposition: each trace is divided into blocks of
+	<blockSize> samples, running extremes are kept from the start and from the end of each
+	block, and a sparse table holds the extremes of every run of 2**k whole blocks.  A
+	window then spans (part of) a block at each end, whose extremes are read directly, and
+	at most two overlapping runs of whole blocks in between.  (Windows that fall within a
+	single block are simply reduced, at a cost of at most <blockSize> samples.)
+
+	Extremes are exact, so the peak-to-peak values are identical to those of
+	WindowMagnitudes().  There is deliberately no equivalent for mean rectified values:
+	differences of cumulative sums would agree with WindowMagnitudes() only to within
+	floating-point rounding.  The index takes roughly four times the memory of the traces
+	themselves:  see EstimatedBytes().
+	"""
+	def __init__( self, traces, blockSize=16 ):
+		self.traces = traces = numpy.asarray( traces, dtype=numpy.float64 )
+		self.nTraces, self.nSamples = traces.shape
+		self.blockSize = blockSize = max( int( blockSize ), 1 )
+		nBlocks = -( -self.nSamples // blockSize )
+		padded = numpy.empty( ( self.nTraces, nBlocks * blockSize ), dtype=numpy.float64 )
+		padded[ :, :self.nSamples ] = traces
+		padded[ :, self.nSamples: ] = traces[ :, -1: ] # padding with a value from the final block cannot change its extremes
+		blocks = padded.reshape( self.nTraces, nBlocks, blockSize )
+		self.extremes = Bunch()
+		for name, operator in [ ( 'max', numpy.maximum ), ( 'min', numpy.minimum ) ]:
+			fromStart = operator.accumulate( blocks, axis=2 ).reshape( self.nTraces, -1 )[ :, :self.nSamples ]
+			fromEnd = operator.accumulate( blocks[ :, :, ::-1 ], axis=2 )[ :, :, ::-1 ].reshape( self.nTraces, -1 )[ :, :self.nSamples ]
+			table = [ operator.reduce( blocks, axis=2 ) ]
+			while 2 ** len( table ) <= nBlocks:
+				span = 2 ** ( len( table ) - 1 ); previous = table[ -1 ]
+				table.append( operator( previous[ :, :-span ], previous[ :, span: ] ) )
+			self.extremes[ name ] = Bunch( operator=operator, fromStart=fromStart, fromEnd=fromEnd, table=table )
+
+	@staticmethod
+	def EstimatedBytes( nTraces, nSamples, blockSize=16 ):
+		"""
+		Return the approximate size, in bytes, of a WindowIndex of the given dimensions
+		(not counting the traces themselves).
+		"""
+		nBlocks = -( -int( nSamples ) // max( int( blockSize ), 1 ) )
+		nLevels = int( math.log( max( nBlocks, 1 ), 2 ) ) + 1
+		return 8 * int( nTraces ) * ( 4 * int( nSamples ) + 2 * nBlocks * nLevels )
+
+	@property
+	def nbytes( self ):
+		arrays = []
+		for extremes in self.extremes.values(): arrays += [ extremes.fromStart, extremes.fromEnd ] + extremes.table
+		return sum( a.nbytes for a in arrays )
+
+	def Extreme( self, name, start, stop ):
+		"""
+		Return the maximum (name='max') or minimum (name='min') of each trace between sample
+		indices <start> (inclusive) and <stop> (exclusive).
+		"""
+		extremes = self.extremes[ name ]
+		first, last = start // self.blockSize, ( stop - 1 ) // self.blockSize
+		if first == last: return extremes.operator.reduce( self.traces[ :, start:stop ], axis=1 )
+		result = extremes.operator( extremes.fromEnd[ :, start ], extremes.fromStart[ :, stop - 1 ] )
+		nWhole = last - first - 1
+		if nWhole:
+			level = int( math.log( nWhole, 2 ) )
+			while 2 ** ( level + 1 ) <= nWhole: level += 1 # guard against rounding in math.log
+			while 2 ** level > nWhole: level -= 1
+			table = extremes.table[ level ]
+			result = extremes.operator( result, extremes.operator( table[ :, first + 1 ], table[ :, last - 2 ** level ] ) )
+		return result
+
+	def peakToPeak( self, window ):
+		"""
+		Equivalent to WindowMagnitudes( traces, window, p2p=True ) for the indexed traces.
+		"""
+		start, stop, step = window.indices( self.nSamples )
+		if stop <= start: raise ValueError( 'no samples within the window %r' % window )
+		return self.Extreme( 'max', start, stop ) - self.Extreme( 'min', start, stop )
+
 def ResponseMagnitudes( data, channel, interval, fs, lookback, p2p=False, SingleTrial=False):
 	"""
 	Global helper function called by ResponseOverlay.ResponseMagnitudes():
@@ -302,24 +819,19 @@ def ResponseMagnitudes( data, channel, interval, fs, lookback, p2p=False, Single
 	return a list of response magnitudes, one per trial, for the specified <channel>.
 	If p2p=True, these are peak-to-peak values in the interval of interest. If not, they
 	are mean rectified values across the interval of interest.
-	"""
-	interval = min( interval ), max( interval )
-	start, length = interval[0], interval[1] - interval[0]
-	start = round((start + lookback) * fs) + 1
-	length = round(length * fs)
-	if not SingleTrial:
-		r = []
-		for trial in data:
-			y = trial[ channel ]
-			y = [ yi for i, yi in enumerate( y ) if start <= i < start + length ]
-			if p2p: r.append( max( y ) - min( y ) )
-			else: r.append( sum( abs( yi ) for yi in y ) / float( len( y ) ) )
-		return r
-	else:
-		y = data[channel]
-		y = [yi for i, yi in enumerate(y) if start <= i < start + length]
-		if p2p: return (max(y) - min(y))
-		else: return (sum(abs(yi) for yi in y) / float(len(y)))
+
+	<data> may also be a TrialStore or a trials-by-channels-by-samples numpy array.  With SingleTrial=True,
+	<data> is a single trial ( data[ channelIndex ][ sampleIndex ] ) and a single value is
+	returned.  The work is done by WindowSlice() and WindowMagnitudes(), and in the case of
+	a TrialStore, the results are cached by TrialStore.magnitudes().
+	"""
+	window = WindowSlice( interval, fs, lookback )
+	p2p = bool( p2p )
+	if SingleTrial: return float( WindowMagnitudes( numpy.asarray( data[ channel ], dtype=float ), window, p2p=p2p ) )
+	if isinstance( data, TrialStore ): return data.magnitudes( channel, window, p2p=p2p ).tolist()
+	if isinstance( data, numpy.ndarray ): traces = data[ :, channel ]
+	else: traces = [ trial[ channel ] for trial in data ]
+	return WindowMagnitudes( traces, window, p2p=p2p ).tolist()
 
 def Quantile( x, q, alreadySorted=False ):
 	"""
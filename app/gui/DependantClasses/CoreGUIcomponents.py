@@ -1,6 +1,6 @@
 import Tkinter as tkinter
 from CoreFunctions import *
-import math, matplotlib, ttk, re
+import math, matplotlib, matplotlib.collections, ttk, re
 from TK import TkMPL
 import numpy
 
@@ -489,6 +489,153 @@ class AxisController( object ):
 		elif direction < 0.0: value = max( x for x in vals if rnd( x ) < rnd( value ) )
 		return rnd( value )
 
+class DecimatedLine( object ):
+	"""
+	Manages the data of a matplotlib Line2D instance <line> that displays a long trace,
+	such as a raw EMG epoch.  SetData() keeps the full-resolution data here, but gives the
+	line itself only a MinMaxDecimate()d version, of about two points per horizontal pixel
+	of the axes, covering the visible range of x values.  The data are decimated afresh
+	whenever the horizontal limits of the axes change (e.g. via AxisController.ChangeAxis())
+	or the canvas is resized.  (The caller's own copy of the data, e.g. in a trial store,
+	is never touched.)
+	"""
+	def __init__( self, line ):
+		self.line = line
+		self.x = self.y = None
+		line.axes.callbacks.connect( 'xlim_changed', self.Decimate )
+		line.figure.canvas.mpl_connect( 'resize_event', self.Decimate )
+
+	def SetData( self, x, y ):
+		self.x = numpy.asarray( x, dtype=float )
+		self.y = numpy.asarray( y, dtype=float )
+		self.Decimate()
+
+	def Decimate( self, *pargs ):
+		if self.x is None: return
+		axes = self.line.axes
+		x, y = MinMaxDecimate( self.x, self.y, pixels=axes.bbox.width, xlim=axes.get_xlim() )
+		self.line.set_data( x, y )
+
+class DecimatedCollection( object ):
+	"""
+	The counterpart of DecimatedLine for a matplotlib LineCollection that displays many
+	traces sharing the same sample times, such as the overlaid epochs of a ResponseOverlay.
+	SetData() takes the sample times <x> and a two-dimensional array <y> with one trace per
+	row; the collection's segments are MinMaxDecimate()d versions of all of them, computed
+	in one go, and again whenever the horizontal limits or canvas size change.
+
+	Arrange() chooses which of the traces are shown, and in what order they are drawn (later
+	ones on top), by indexing the cached segments:  it does not decimate anything afresh.
+	"""
+	def __init__( self, collection ):
+		self.collection = collection
+		self.x = self.y = None
+		self.segments = None
+		self.order = None
+		collection.axes.callbacks.connect( 'xlim_changed', self.Decimate )
+		collection.figure.canvas.mpl_connect( 'resize_event', self.Decimate )
+
+	def SetData( self, x, y ):
+		self.x = numpy.asarray( x, dtype=float )
+		self.y = numpy.atleast_2d( numpy.asarray( y, dtype=float ) )
+		self.Decimate()
+
+	def Arrange( self, order=None ):
+		self.order = order
+		if self.segments is None: return
+		if order is None: self.collection.set_segments( self.segments )
+		else: self.collection.set_segments( self.segments[ order ] )
+
+	def Decimate( self, *pargs ):
+		if self.x is None: return
+		axes = self.collection.axes
+		x, y = MinMaxDecimate( self.x, self.y, pixels=axes.bbox.width, xlim=axes.get_xlim() )
+		self.segments = numpy.empty( y.shape + ( 2, ), dtype=float )
+		self.segments[ :, :, 0 ] = x
+		self.segments[ :, :, 1 ] = y
+		self.Arrange( self.order )
+
+class Blitter( object ):
+	"""
+	Fast redrawing of a figure in which only a few artists (feedback bars, target regions,
+	traces...) change from one frame to the next.  The registered artists are marked as
+	animated, so that a full canvas.draw() renders everything else.  Immediately after
+	each full draw (matplotlib's 'draw_event'), the background of each axes is cached and
+	the animated artists are drawn over it.  After that, Update() only has to restore the
+	cached background of each axes whose artists have changed, draw those artists, and
+	blit the axes' region to the screen.
+
+	The cache is invalidated whenever the limits of one of the axes change (for example
+	through an AxisController), in which case the next Update() falls back to a full
+	draw.  Resizing the canvas causes a full draw anyway, and hence a fresh cache.
+
+	Hidden artists, and all the artists of hidden axes, are never drawn, and the regions of
+	hidden axes are never cached or blitted.  Showing or hiding one of the axes (as
+	ToggleVisibilityRCwindows() does) also makes the next Update() a full draw.
+	"""
+	def __init__( self, figure, artists=() ):
+		self.figure = figure
+		self.artists = []
+		self.axes = []
+		self.shown = []  # the axes that were visible at the last full draw
+		self.dirty = set()
+		self.backgrounds = None
+		self.figure.canvas.mpl_connect( 'draw_event', self.Capture )
+		for artist in artists: self.Add( artist )
+
+	def Add( self, artist ):
+		"""
+		Register <artist>, which must already belong to one of the axes of self.figure.
+		"""
+		artist.set_animated( True )
+		self.artists.append( artist )
+		if artist.axes not in self.axes:
+			self.axes.append( artist.axes )
+			artist.axes.callbacks.connect( 'xlim_changed', self.Invalidate )
+			artist.axes.callbacks.connect( 'ylim_changed', self.Invalidate )
+		self.backgrounds = None
+
+	def Invalidate( self, *pargs ):
+		self.backgrounds = None
+
+	def MarkDirty( self, artist ):
+		"""
+		Note that <artist> has changed and needs to be redrawn by the next Update().
+		Return False if <artist> is not managed by this Blitter.
+		"""
+		if artist not in self.artists: return False
+		self.dirty.add( artist.axes )
+		return True
+
+	def Capture( self, event=None ):
+		"""
+		Callback registered for matplotlib's 'draw_event', which is issued at the end of every
+		full draw, before the result is shown on screen.
+		"""
+		canvas = self.figure.canvas
+		self.shown = self.VisibleAxes()
+		self.backgrounds = dict( ( axes, canvas.copy_from_bbox( axes.bbox ) ) for axes in self.shown )
+		for artist in self.artists:
+			if artist.get_visible() and artist.axes in self.backgrounds: artist.axes.draw_artist( artist )
+		self.dirty.clear()
+
+	def VisibleAxes( self ):
+		return [ axes for axes in self.axes if axes.get_visible() ]
+
+	def Update( self ):
+		"""
+		Bring the display up to date, by blitting if possible, or with a full draw if not.
+		"""
+		canvas = self.figure.canvas
+		if self.backgrounds == None or self.shown != self.VisibleAxes(): canvas.draw(); return
+		for axes in self.shown:
+			if axes not in self.dirty: continue
+			canvas.restore_region( self.backgrounds[ axes ] )
+			for artist in self.artists:
+				if artist.axes is axes and artist.get_visible(): axes.draw_artist( artist )
+			canvas.blit( axes.bbox )
+		self.dirty.clear()
+
 class DetermineRCPoint(tkinter.Toplevel):
 
 	def __init__(self, parent, ntrials, data, channel):
@@ -1096,7 +1243,7 @@ class MVC( object ):
 		"""
 		Create the necessary matplotlib artists  (no Tk code or objects here)
 
-		<data>     : a list of EMG values, one per SampleBlock
+		<data>     : a sequence (list, numpy array or ScalarStore) of EMG values, one per SampleBlock
 		<fs>       : the sampling rate of <data>, i.e. the SampleBlock rate (not the raw sampling rate of the BCI2000 signal)
 		<axes>     : optionally specify an existing matplotlib axes to draw on
 		<callback> : function to be called whenever the StickySpanSelector self.selector changes
@@ -1104,13 +1251,13 @@ class MVC( object ):
 		if axes == None: axes = matplotlib.pyplot.gca()
 		else: matplotlib.pyplot.figure( axes.figure.number ).sca( axes )
 		self.axes = axes
-		self.data = data
+		self.data = numpy.asarray( data, dtype=float )
 		self.fs = fs
 		self.callback = callback
-		self.time = TimeBase( self.data, fs=self.fs, lookback=0 )
+		self.time = numpy.asarray( TimeBase( self.data, fs=self.fs, lookback=0 ) )
 		self.line = matplotlib.pyplot.plot( self.time, self.data )[ 0 ]
 		self.axes.grid( True )
-		peaktime = self.time[ self.data.index( max( self.data ) ) ]
+		peaktime = self.time[ self.data.argmax() ]
 		self.selector = StickySpanSelector( self.axes, initial=( peaktime - 0.1, peaktime + 0.1 ), onselect=self.callback, granularity=0.050, units='s', fmt='%g', color='#FF6666', text_y=0.98, text_verticalalignment='top', text_visible=False )
 		self.ycon = AxisController( self.axes, 'y', fmt='%g', units='V', start=self.axes.get_ylim(), narrowest=self.axes.get_ylim() ).Home()
 		self.xcon = AxisController( self.axes, 'x', fmt='%g', units='s', start=self.axes.get_xlim(),    widest=self.axes.get_xlim() ).Home()
@@ -1141,9 +1288,9 @@ class MVC( object ):
 		"""
 		if range == None: range = self.selector.get()
 		if range == None: ysub = []
-		else: ysub = [ y for t, y in zip( self.time, self.data ) if range[ 0 ] <= t <= range[ 1 ] ]
+		else: ysub = self.data[ self.time.searchsorted( range[ 0 ], side='left' ) : self.time.searchsorted( range[ 1 ], side='right' ) ]
 		if len( ysub ):
-			avg = sum( ysub ) / float( len( ysub ) )
+			avg = float( ysub.mean() )
 			self.estimate = FormatWithUnits( avg, fmt='%.1f', units='V' )
 			self.axes.set_title( 'Estimated MVC = ' + self.estimate )
 		else:
@@ -1183,27 +1330,79 @@ class ResponseOverlay( object ):
 			 0 : Bunch( color=color,     alpha=0.3, zorder=2, linewidth=1 ),
 			+1 : Bunch( color='#FF00FF', alpha=0.8, zorder=3, linewidth=2 ),
 		}
-		self.lines = []
 		self.emphasis = list( emphasis )
-		for trial in self.data:
-			values = trial[ self.channel ]
-			self.lines += matplotlib.pyplot.plot( TimeBase( values, self.fs, self.lookback ), values, **self.lineprops[ 0 ] )
-			if not len( emphasis ): self.emphasis.append( 0 )
+		if not len( self.emphasis ): self.emphasis = [ 0 ] * len( self.data )
+		# All the traces are drawn by a single LineCollection, fed from a trials-by-samples
+		# array: the appearance of each trace is set by its entry in the collection's colour
+		# and linewidth arrays, and emphasized traces are drawn last so that they are on top.
+		self.collection = matplotlib.collections.LineCollection( [], zorder=self.lineprops[ 0 ].zorder )
+		axes.add_collection( self.collection, autolim=False )
+		self.decimated = DecimatedCollection( self.collection )
+		self.traces = None # ( key, array, data ) for the most recently converted channel, where key is ( id( data ), channel, nTrials )
+		self.shown = None  # ( id( data ), channel, rectified, nTrials ) for the data currently in self.decimated
 		self.yController.Home()
 		self.xController.Home()
 		self.Update( rectified=rectified )
 
+	def Traces( self ):
+		"""
+		Return the current channel of every trial as one trials-by-samples numpy array, padded
+		with NaN at the end should some trials be shorter than others.  The array is cached
+		until self.data is replaced, or the channel or the number of trials changes.  If the
+		data are in a TrialStore, the array is simply a view of the store.
+		"""
+		key = ( id( self.data ), self.channel, len( self.data ) )
+		if self.traces == None or self.traces[ 0 ] != key:
+			# the cache holds on to the data it was made from, so that their id() cannot be re-used by a replacement while it is cached
+			if isinstance( self.data, TrialStore ):
+				self.traces = ( key, self.data.channel( self.channel ), self.data )
+				return self.traces[ 1 ]
+			rows = [ numpy.asarray( trial[ self.channel ], dtype=float ).ravel() for trial in self.data ]
+			array = numpy.empty( ( len( rows ), max( [ len( row ) for row in rows ] + [ 0 ] ) ), dtype=float )
+			array.fill( numpy.nan )
+			for array_row, row in zip( array, rows ): array_row[ :len( row ) ] = row
+			self.traces = ( key, array, self.data )
+		return self.traces[ 1 ]
+
+	def Emphasize( self ):
+		"""
+		Bring the colour, transparency, width and drawing order of each trace into line with
+		self.emphasis and self.lineprops.  Only the collection's per-trace property arrays are
+		changed:  the (decimated) data are left alone.  Removed trials, being transparent, are
+		left out altogether.
+		"""
+		levels = sorted( self.lineprops )
+		props = [ self.lineprops[ level ] for level in levels ]
+		rgba = numpy.array( [ matplotlib.colors.colorConverter.to_rgba( p.color, p.alpha ) for p in props ] )
+		widths = numpy.array( [ p.linewidth for p in props ], dtype=float )
+		zorders = numpy.array( [ p.zorder for p in props ], dtype=float )
+		emphasis = numpy.zeros( len( self.data ), dtype=int )
+		given = numpy.asarray( self.emphasis[ :len( emphasis ) ], dtype=int )
+		emphasis[ :len( given ) ] = given
+		which = numpy.searchsorted( levels, numpy.clip( emphasis, levels[ 0 ], levels[ -1 ] ) )
+		order = numpy.argsort( zorders[ which ], kind='mergesort' )
+		order = order[ rgba[ which[ order ], 3 ] > 0 ]
+		self.decimated.Arrange( order )
+		self.collection.set_color( rgba[ which[ order ] ] )
+		self.collection.set_linewidths( widths[ which[ order ] ] )
+
 	def Update( self, rectified=None, color=None, channel=None ):
 		"""
 		Update the display. Called by AnalysisWindow.UpdateResults()
+		The traces are only re-computed if the data, the channel, the rectification setting
+		or the number of trials have changed since last time: otherwise only their appearance
+		is.
 		"""
 		if rectified != None: self.rectified = rectified
 		if color != None: self.lineprops[ 0 ].color = color
 		if channel != None: self.channel = channel
-		for trial, line, emphasis in zip( self.data, self.lines, self.emphasis ):
-			if self.rectified: line.set_ydata( [ abs( value ) for value in trial[ self.channel ] ] )
-			else: line.set_ydata( trial[ self.channel ] )
-			line.set( **self.lineprops[ emphasis ] )
+		shown = ( id( self.data ), self.channel, self.rectified, len( self.data ) ) # self.traces keeps the data alive, so the id() is not re-used
+		if shown != self.shown:
+			values = self.Traces()
+			if self.rectified: values = numpy.abs( values )
+			self.decimated.SetData( TimeBase( values.shape[ 1 ], self.fs, self.lookback ), values )
+			self.shown = shown
+		self.Emphasize()
 		ylim = self.axes.get_ylim()
 		if self.rectified: self.axes.set_ylim( [ 0, ylim[ 1 ] ] )
 		else: self.axes.set_ylim( [ -ylim[ 1 ], ylim[ 1 ] ] )
@@ -1274,6 +1473,20 @@ class ResponseSequence( object ):
 				AxesPosition( self.axes, right=0.75 )
 				p = AxesPosition( self.axes ); rgap = 1.0 - p.right
 				self.frame.place( in_=widget, relx=1.0 - rgap / 2.0, rely=1.0 - p.bottom - p.height/2, relheight=p.height*1.1, anchor='center' )
+		# The markers are drawn by two persistent collections, whose offsets and colours are
+		# replaced on each Update():  nothing is created or destroyed in the axes after this.
+		self.markers = Bunch(
+			h=self.axes.scatter( [], [], s=100, marker='o', zorder=2 ),
+			m=self.axes.scatter( [], [], s=100, marker='^', zorder=2 ),
+		)
+		self.texts = Bunch(
+			m=self.axes.text( 0.02, 0.90, '', bbox=dict( facecolor=comparisonColor, alpha=0.5 ), fontsize=12, transform=self.axes.transAxes, visible=False ),
+			h=self.axes.text( 0.02, 0.83, '', bbox=dict( facecolor=responseColor,   alpha=0.5 ), fontsize=12, transform=self.axes.transAxes, visible=False ),
+		)
+		self.axes.grid( True )
+		self.yController = None
+		self.ytop = None
+		self.xticks = None
 		self.Update(xlabels=xlabels)
 
 	def Update( self, pooling=None, p2p=None,xlabels=[]):
@@ -1284,15 +1497,16 @@ class ResponseSequence( object ):
 		if pooling != None: self.pooling = pooling
 		if p2p != None: self.p2p = p2p
 		def pool( x, pooling, emphasis=None ):
-			ni, n, pooled = pooling, [], []
-			for start in range( 0, len( x ) - pooling + 1, pooling ):
-				xsub = x[ start : start + pooling ]
-				if emphasis != None:
-					keep = [ em >= 0 for em in emphasis[ start : start + pooling ] ]
-					if sum( keep ): xsub = [ eachVal for eachVal, keepEachVal in zip( xsub, keep ) if keepEachVal ]
-					# do not remove any if you would remove *all* in the current pool (if that's the case, this data-point will be excluded completely from analysis later on anyway, but let's compute where it would have been)
-				pooled.append( sum( xsub ) / float( len( xsub ) ) )
-				n.append( ni ); ni += pooling
+			x = numpy.asarray( x, dtype=float )
+			nPools = len( x ) // pooling
+			x = x[ :nPools * pooling ].reshape( nPools, pooling )
+			if emphasis is None: pooled = x.mean( axis=1 )
+			else:
+				keep = ( numpy.asarray( emphasis[ :nPools * pooling ] ) >= 0 ).reshape( nPools, pooling )
+				keep[ ~keep.any( axis=1 ) ] = True
+				# do not remove any if you would remove *all* in the current pool (if that's the case, this data-point will be excluded completely from analysis later on anyway, but let's compute where it would have been)
+				pooled = numpy.where( keep, x, 0.0 ).sum( axis=1 ) / keep.sum( axis=1 )
+			n = pooling * numpy.arange( 1, nPools + 1 )
 			return n, pooled
 		def autopool(c, x ):
 			#autopool uses currents (xlabel) to automaticall group responses
@@ -1308,66 +1522,80 @@ class ResponseSequence( object ):
 
 			return xh, pooled
 
-		xh, h = pool( self.overlay.ResponseMagnitudes( p2p=self.p2p, type='response'   ),  pooling=self.pooling, emphasis=self.overlay.emphasis )
-		xm, m = pool( self.overlay.ResponseMagnitudes( p2p=self.p2p, type='comparison' ),  pooling=self.pooling, emphasis=self.overlay.emphasis )
-		xRemoved, removed = pool( [ float( emph < 0 ) for emph in self.overlay.emphasis ], pooling=self.pooling )
-		xHilited, hilited = pool( [ float( emph > 0 ) for emph in self.overlay.emphasis ], pooling=self.pooling )
+		emphasis = numpy.asarray( self.overlay.emphasis, dtype=int )
+		xh, h = pool( self.overlay.ResponseMagnitudes( p2p=self.p2p, type='response'   ),  pooling=self.pooling, emphasis=emphasis )
+		xm, m = pool( self.overlay.ResponseMagnitudes( p2p=self.p2p, type='comparison' ),  pooling=self.pooling, emphasis=emphasis )
+		xRemoved, removed = pool( emphasis < 0, pooling=self.pooling )
+		xHilited, hilited = pool( emphasis > 0, pooling=self.pooling )
 
 		b = self.overlay.ResponseMagnitudes( p2p=self.p2p, type='prestimulus' )
 		self.n = len( b )
-		self.nremoved = sum( [ emphasis < 0 for emphasis in self.overlay.emphasis ] )
-
-		matplotlib.pyplot.figure( self.axes.figure.number ).sca( self.axes )
-		matplotlib.pyplot.cla()
-		mMax = hMax = bSum = bNum = 0.0
-		for x, hVal, mVal, bVal, proportionRemoved, proportionHilited in zip( xRemoved, h, m, b, removed, hilited ):
-			hHandle, = matplotlib.pyplot.plot( x, hVal, linestyle='none', marker='o', markersize=10, color=self.overlay.responseSelector.rectprops[ 'facecolor' ] )
-			mHandle, = matplotlib.pyplot.plot( x, mVal, linestyle='none', marker='^', markersize=10, color=self.overlay.comparisonSelector.rectprops[ 'facecolor' ] )
-			if proportionHilited > 0.001: [ handle.set( markeredgecolor=self.overlay.lineprops[ +1 ].color, markeredgewidth=2 ) for handle in hHandle, mHandle ]
-			if proportionHilited > 0.999: [ handle.set( markerfacecolor=self.overlay.lineprops[ +1 ].color ) for handle in hHandle, mHandle ]
-			if proportionRemoved > 0.001: [ handle.set( alpha=0.5 ) for handle in hHandle, mHandle ]
-			if proportionRemoved > 0.999: [ handle.set( markerfacecolor='#FFFFFF' ) for handle in hHandle, mHandle ]
-			else:
-				mMax = max( mVal, mMax )
-				hMax = max( hVal, hMax )
-				bSum += bVal
-				bNum += 1.0
-
-		self.yController = AxisController( self.axes, 'y', units='V', fmt='%g', start=self.axes.get_ylim() )
-		self.yController.ChangeAxis( start=( 0, max( self.axes.get_ylim() ) ) )
-		self.axes.grid( True )
-		xt = list( xh )
-		while len( xt ) > 15: xt = xt[ 1::2 ]
-		self.axes.set( xlim=( 0	, max( xh ) + 1 ))#, title='Left-click to toggle highlighting; right-click to toggle removal' )
-
-		self.axes.set_xticks(xt)
-
-		if xlabels != []:
-			x = [xlabels[i - 1] for i in xt]
-			self.axes.set_xticklabels(x)
+		self.nremoved = int( ( emphasis < 0 ).sum() )
+
+		# marker appearance, one row per pooled point:  highlighted pools get a highlight-
+		# coloured edge (and face, if every trial in them is highlighted);  pools with removed
+		# trials are half-transparent (and hollow, if every trial in them has been removed)
+		colorConverter = matplotlib.colors.colorConverter
+		hiliteColor = colorConverter.to_rgba( self.overlay.lineprops[ +1 ].color )
+		alpha = numpy.where( removed > 0.001, 0.5, 1.0 )
+		edgewidths = numpy.where( hilited > 0.001, 2.0, matplotlib.rcParams[ 'lines.markeredgewidth' ] )
+		for name, x, values, selector in [ ( 'h', xh, h, self.overlay.responseSelector ), ( 'm', xm, m, self.overlay.comparisonSelector ) ]:
+			facecolors = numpy.tile( colorConverter.to_rgba( selector.rectprops[ 'facecolor' ] ), ( len( x ), 1 ) )
+			edgecolors = facecolors.copy()
+			edgecolors[ hilited > 0.001 ] = hiliteColor
+			facecolors[ hilited > 0.999 ] = hiliteColor
+			facecolors[ removed > 0.999 ] = colorConverter.to_rgba( '#FFFFFF' )
+			facecolors[ :, 3 ] *= alpha
+			edgecolors[ :, 3 ] *= alpha
+			markers = self.markers[ name ]
+			markers.set_offsets( numpy.column_stack( ( x, values ) ).reshape( -1, 2 ) )
+			markers.set_facecolors( facecolors )
+			markers.set_edgecolors( edgecolors )
+			markers.set_linewidths( edgewidths )
+
+		kept = removed <= 0.999
+		mMax = max( [ 0.0 ] + list( m[ kept ] ) )
+		hMax = max( [ 0.0 ] + list( h[ kept ] ) )
+		bSum = float( numpy.sum( numpy.asarray( b[ :len( kept ) ], dtype=float )[ kept ] ) )
+		bNum = float( kept.sum() )
+
+		# The vertical axis runs from 0 to wherever matplotlib would autoscale the top to.
+		# The AxisController is only replaced if that has changed.
+		ylim = self.axes.get_ylim()
+		points = numpy.concatenate( ( self.markers.h.get_offsets(), self.markers.m.get_offsets() ) )
+		self.axes.ignore_existing_data_limits = True
+		if len( points ): self.axes.update_datalim( points )
+		self.axes.set_autoscaley_on( True )
+		self.axes.autoscale_view( scalex=False )
+		ytop = max( self.axes.get_ylim() )
+		if self.yController == None or ytop != self.ytop:
+			self.yController = AxisController( self.axes, 'y', units='V', fmt='%g', start=self.axes.get_ylim() )
+			self.yController.ChangeAxis( start=( 0, ytop ) )
+			self.ytop = ytop
+		else: self.axes.set_ylim( ylim, emit=False )
+
+		xticks = ( tuple( xh ), tuple( xlabels ) )
+		if xticks != self.xticks:
+			xt = list( xh )
+			while len( xt ) > 15: xt = xt[ 1::2 ]
+			self.axes.set( xlim=( 0	, max( list( xh ) + [ 0 ] ) + 1 ))#, title='Left-click to toggle highlighting; right-click to toggle removal' )
+
+			self.axes.set_xticks(xt)
+
+			if xlabels != []:
+				x = [xlabels[i - 1] for i in xt]
+				self.axes.set_xticklabels(x)
+			self.xticks = xticks
 
 		# Section for a text box, that shows the M and H values for any selected points.
-		# Adding a text overlay for the H and M values
-
-		for i in range(0, len(self.axes.texts)):
-			self.axes.texts.remove(self.axes.texts[i])
 		# Broken down into which of the sequence need to be measured
-		indEmphasis = [self.overlay.emphasis[i] for i in
-					   range(self.pooling - 1, len(self.overlay.emphasis), self.pooling)]
-		indSelected = [i for i, j in enumerate(indEmphasis) if j == 1]
-
-		if indSelected != []:
-			Mvalue = ', '.join('{:.2f}'.format(m[i] * 1000) for i in indSelected)
-			Hvalue = ', '.join('{:.2f}'.format(h[i] * 1000) for i in indSelected)
-
-			# Mvalue = '{:.2f}'.format(self.axes.lines[indSelected].get_data()[1].tolist()[0] * 1000)
-			# Hvalue = '{:.2f}'.format(self.axes.lines[indSelected-1].get_data()[1].tolist()[0] * 1000)
-			self.axes.text(0.02, 0.9, 'M: ' + Mvalue + 'mV',
-						   bbox=dict(facecolor=self.overlay.comparisonSelector.rectprops['facecolor'], alpha=0.5),
-						   fontsize=12, transform=self.axes.transAxes)
-			self.axes.text(0.02, 0.83, 'H: ' + Hvalue + 'mV',
-						   bbox=dict(facecolor=self.overlay.responseSelector.rectprops['facecolor'], alpha=0.5),
-						   fontsize=12, transform=self.axes.transAxes)
+		indEmphasis = emphasis[ self.pooling - 1::self.pooling ]
+		indSelected = numpy.flatnonzero( indEmphasis == 1 )
+
+		for name, values, label in [ ( 'm', m, 'M: ' ), ( 'h', h, 'H: ' ) ]:
+			text = self.texts[ name ]
+			if len( indSelected ): text.set_text( label + ', '.join( '{:.2f}'.format( values[ i ] * 1000 ) for i in indSelected ) + 'mV' )
+			text.set_visible( len( indSelected ) > 0 )
 
 		self.panel.bg.set( bSum / max( bNum, 1.0 ) )
 		self.panel.mmax.set( mMax )
@@ -1426,8 +1654,42 @@ class ResponseDistribution( object ):
 				AxesPosition( self.axes, right=0.65 )
 				p = AxesPosition( self.axes ); rgap = 1.0 - p.right
 				self.frame.place( in_=widget, relx=1.0 - rgap * 0.4, rely=1.0 - p.bottom - p.height/2, relheight=p.height*1.1, anchor='center' )
+		# The bars of the histogram and the target lines are created once and then moved
+		# around by Update(), which only re-computes the statistics of the response
+		# magnitudes that have actually changed (see ResponseStats()).
+		self.patches = []
+		self.counts, self.binCenters = [], []
+		self.stats = {}
+		self.xController = None
+		self.xlim = None
+		self.downline, self.upline, self.meanline = self.axes.plot( [ [ 0 ] * 3, [ 0 ] * 3 ], [ [ 0 ] * 3, [ 1 ] * 3 ], color='#FF0000', linewidth=4, alpha=0.5, transform=self.axes.get_xaxis_transform() )
 		self.Update()
 
+	def ResponseStats( self, type ):
+		"""
+		Return the response magnitudes of the trials that have not been removed, for the
+		interval specified by <type> (as in ResponseOverlay.ResponseMagnitudes()), together
+		with their sorted values, mean and median.  The result is cached and only computed
+		afresh if the interval, the magnitude measure, the channel, the number of trials or
+		the set of removed trials has changed since last time, so that moving one selector
+		only costs the statistics of that one interval.
+		"""
+		selector = dict( response=self.overlay.responseSelector, comparison=self.overlay.comparisonSelector, prestimulus=self.overlay.prestimulusSelector )[ type ]
+		key = ( tuple( selector.get() ), self.p2p, self.overlay.channel, len( self.overlay.data ), tuple( self.overlay.emphasis ) )
+		cached = self.stats.get( type )
+		if cached and cached[ 0 ] == key: return cached[ 1 ]
+		x = numpy.asarray( self.overlay.ResponseMagnitudes( p2p=self.p2p, type=type ), dtype=float )
+		keep = numpy.asarray( self.overlay.emphasis[ :len( x ) ], dtype=int ) >= 0
+		x = x[ :len( keep ) ][ keep ]
+		xSorted = numpy.sort( x )
+		if len( x ) == 0: xMean = xMedian = 0.0
+		else:
+			xMean = float( x.mean() )
+			xMedian = float( Quantile( xSorted, 0.5, alreadySorted=True ) )
+		result = x, xSorted, xMean, xMedian
+		self.stats[ type ] = ( key, result )
+		return result
+
 	def Update( self, nbins=None, targetpc=None, p2p=None ):
 		"""
 		Update the display. Called by AnalysisWindow.UpdateResults()
@@ -1436,34 +1698,41 @@ class ResponseDistribution( object ):
 		if targetpc != None: self.targetpc = targetpc
 		if p2p != None: self.p2p = p2p
 
-		def ResponseStats( type ):
-			x = self.overlay.ResponseMagnitudes( p2p=self.p2p, type=type )
-			x = [ xi for xi, emphasis in zip( x, self.overlay.emphasis ) if emphasis >= 0 ]
-			xSorted = sorted( x )
-			if len( x ) == 0: xMedian = xMean = 0.0
-			else:
-				xMean = sum( x ) / float( len ( x ) )
-				xMedian = Quantile( xSorted, 0.5, alreadySorted=True )
-			return x, xSorted, xMean, xMedian
 		self.nremoved = sum( [ emphasis < 0 for emphasis in self.overlay.emphasis ] )
-		r, rSorted, rMean, rMedian = ResponseStats( 'response' )
-		c, cSorted, cMean, cMedian = ResponseStats( 'comparison' )
-		b, bSorted, bMean, bMedian = ResponseStats( 'prestimulus' )
+		r, rSorted, rMean, rMedian = self.ResponseStats( 'response' )
+		c, cSorted, cMean, cMedian = self.ResponseStats( 'comparison' )
+		b, bSorted, bMean, bMedian = self.ResponseStats( 'prestimulus' )
 		n = len( r )
 		if n: targets = Quantile( rSorted, ( self.targetpc / 100.0, 1.0 - self.targetpc / 100.0 ), alreadySorted=True )
 		else: targets = [ 0 ]
 		downtarget, uptarget = max( targets ), min( targets )
-		matplotlib.pyplot.figure( self.axes.figure.number ).sca( self.axes )
-		matplotlib.pyplot.cla()
-		#print 'calculated = ' + repr( r )
+
 		if len( r ) == 1: extra = dict( range=[ r[ 0 ] * 0.9, r[ 0 ] * 1.1 ] )
 		else: extra = {}
-		if len( r ): self.counts, self.binCenters, self.patches = matplotlib.pyplot.hist( r, bins=self.nbins, facecolor=self.overlay.lineprops[ 0 ].color, edgecolor='none', **extra )
-		else: self.counts, self.binCenters, self.patches = [], [], []
-		self.xController = AxisController( self.axes, 'x', units='V', fmt='%g', start=self.axes.get_xlim() )
-		self.xController.Home()
-		vals = [ downtarget, uptarget, rMean ]
-		self.downline, self.upline, self.meanline = matplotlib.pyplot.plot( [ vals, vals ], [ [ 0 for v in vals ], [ 1 for v in vals ] ], color='#FF0000', linewidth=4, alpha=0.5, transform=self.axes.get_xaxis_transform() )
+		if len( self.patches ) != self.nbins:
+			for patch in self.patches: patch.remove()
+			self.patches = [ self.axes.add_patch( matplotlib.patches.Rectangle( ( 0, 0 ), 0, 0, facecolor=self.overlay.lineprops[ 0 ].color, edgecolor='none' ) ) for i in range( self.nbins ) ]
+		if len( r ):
+			self.counts, self.binCenters = numpy.histogram( r, bins=self.nbins, **extra ) # NB: like pyplot.hist(), this returns the bin edges, despite the name
+			for patch, count, left, right in zip( self.patches, self.counts, self.binCenters[ :-1 ], self.binCenters[ 1: ] ):
+				patch.set( x=left, width=right - left, height=count, facecolor=self.overlay.lineprops[ 0 ].color, visible=True )
+		else:
+			self.counts, self.binCenters = [], []
+			for patch in self.patches: patch.set_visible( False )
+
+		# Let matplotlib autoscale to the histogram, as it would after pyplot.hist(), and only
+		# replace the AxisController if that changes the horizontal limits.
+		xlim = self.axes.get_xlim()
+		self.axes.ignore_existing_data_limits = True
+		if len( self.counts ): self.axes.update_datalim( [ ( self.binCenters[ 0 ], 0 ), ( self.binCenters[ -1 ], max( self.counts ) ) ] )
+		self.axes.set_autoscale_on( True )
+		self.axes.autoscale_view()
+		if self.xController == None or tuple( self.axes.get_xlim() ) != self.xlim:
+			self.xlim = tuple( self.axes.get_xlim() )
+			self.xController = AxisController( self.axes, 'x', units='V', fmt='%g', start=self.xlim )
+			self.xController.Home()
+		else: self.axes.set_xlim( xlim, emit=False )
+		for line, value in zip( [ self.downline, self.upline, self.meanline ], [ downtarget, uptarget, rMean ] ): line.set_xdata( [ value, value ] )
 		self.panel.n.set( n )
 		self.panel.prestimulus.set( [ bMedian, bMean ] )
 		self.panel.comparison.set(  [ cMedian, cMean ] )
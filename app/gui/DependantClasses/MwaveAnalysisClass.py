@@ -8,8 +8,10 @@ class MWaveAnalysisWindow(tkinter.Toplevel, TkMPL):
     """
     ###AMIR
     An M Wave Analysis Window is created when the "M-Wave Analysis" button is
-    pressed on the ct tab of the GUI().
+    pressed on the ct tab of the GUI().  Like the AnalysisWindow, it has its figures
+    rendered off the Tk thread.
     """
+    offThreadRendering = True
 
     def __init__(self, parent, mode, operator):
 
@@ -56,6 +58,7 @@ class MWaveAnalysisWindow(tkinter.Toplevel, TkMPL):
             while len(keys):
                 xi = keys.pop(0)
                 while xi in self.parent.widgets: del self.parent.widgets[xi]
+            if hasattr(self.parent, 'redraws'): self.parent.redraws.Forget(*self.MatchArtists('figure')) # so that they are not drawn once destroyed
 
             del self.parent.mwaveGUI
             self.destroy()
@@ -382,9 +385,7 @@ class MWaveAnalysisWindow(tkinter.Toplevel, TkMPL):
 
         if len(self.parent.MwaveLoadedData):
             self.parent.MwaveLoadedData = [0, 0]
-            self.parent.MwaveFigureFlag = 3
-            self.parent.NewTrial(self.parent.MwaveLoadedData, store=False)
-            self.parent.MwaveFigureFlag = 0
+            self.parent.PlotLoadedData(self.parent.MwaveLoadedData)
             self.LoadMwaveButton.config(text='Load Previous Data')
             self.parent.MwaveLoadedData = []
         else:
@@ -416,9 +417,7 @@ class MWaveAnalysisWindow(tkinter.Toplevel, TkMPL):
             if len(LoadedSignal):
                 self.parent.MwaveLoadedData = [TimeBase(LoadedSignal, self.LoadedDatafs, self.LoadedDataLookback),
                                                LoadedSignal]
-                self.parent.MwaveFigureFlag = 3
-                self.parent.NewTrial(self.parent.MwaveLoadedData, store=False)
-                self.parent.MwaveFigureFlag = 0
+                self.parent.PlotLoadedData(self.parent.MwaveLoadedData)
 
                 self.LoadMwaveButton.config(text='Clear Data')
 
@@ -3,7 +3,7 @@
 import Tkinter as tkinter
 import tkMessageBox
 import numpy, time
-from ..CoreFunctions import Bunch
+from ..CoreFunctions import Bunch, WindowSlice, WindowMagnitudes
 from ..CoreGUIcomponents import Dialog, OptionsDialog
 from collections import OrderedDict
 
@@ -916,7 +916,9 @@ class BackgroundCheck(object):
         Will return ProcessCompleted if enough data has been gathered and that data is settled such that the criteria are met
         """
 
-        data = numpy.trim_zeros(numpy.asarray(self.parent.data['vc']))
+        data = self.parent.data['vc']
+        if hasattr(data, 'trimmed'): data = data.trimmed() #ScalarStore: a view, without copying the whole run
+        else: data = numpy.trim_zeros(numpy.asarray(data))
         l = len(data)
         ProcessCompleted = False
 
@@ -1143,28 +1145,10 @@ class RCAnalysis(object):
         :param SingleTrial: If only one trial of data (Could be tested with duck typing)
         :return: amplitude(s)
         """
-
-        interval = min(interval), max(interval)
-        start, length = interval[0], interval[1] - interval[0]
-        start = round((start + lookback) * fs)
-        length = round(length * fs)
-        r = []
-        if SingleTrial:
-            y = data
-            y = [yi for i, yi in enumerate(y) if start <= i < start + length]
-            if p2p:
-                r.append(max(y) - min(y))
-            else:
-                r.append(sum(abs(yi) for yi in y) / float(len(y)))
-        else:
-            for trial in data:
-                y=trial
-                y = [yi for i, yi in enumerate(y) if start <= i < start + length]
-                if p2p:
-                    r.append(max(y) - min(y))
-                else:
-                    r.append(sum(abs(yi) for yi in y) / float(len(y)))
-        return r
+        # NB: unlike CoreFunctions.ResponseMagnitudes, the window here has always started one sample earlier (offset=0)
+        window = WindowSlice(interval, fs, lookback, offset=0)
+        if SingleTrial: data = [data]
+        return WindowMagnitudes(data, window, p2p=bool(p2p)).tolist()
 
     def DetermineCurrent(self,HAmplitudes,MAmplitudes,BGAmplitudes,Currents,Pooling,RawData):
         """
@@ -1346,57 +1330,82 @@ class RCAnalysis(object):
 
         Mwin = (float(self.parent.operator.params._ComparisonStartMsec[self.channel]) / 1000,float(self.parent.operator.params._ComparisonEndMsec[self.channel]) / 1000)
         Hwin = (float(self.parent.operator.params._ResponseStartMsec[self.channel]) / 1000,float(self.parent.operator.params._ResponseEndMsec[self.channel]) / 1000)
-        Di = numpy.sum(numpy.asarray(Data),0)
+        Di = numpy.sum(numpy.asarray(Data, dtype=float),0)
+        cumulative = numpy.abs(Di).cumsum() #one pass over the summed trace serves both windows
 
-        NewMwin = self.RefineWindows(Di, Mwin)
-        NewHwin = self.RefineWindows(Di, Hwin)
+        NewMwin = self.RefineWindows(Di, Mwin, cumulative=cumulative)
+        NewHwin = self.RefineWindows(Di, Hwin, cumulative=cumulative)
 
         return NewMwin, NewHwin
 
-    def RefineWindows(self,Data, ind):
+    def RefineWindows(self,Data, ind, cumulative=None):
         """
         Refine the M or H windows - called by CalculateWindows
+        :param Data: a single (summed) trace
+        :param ind: the window (start,end) in seconds
+        :param cumulative: numpy.abs(Data).cumsum(), if already computed
+        :return: the refined window [start,end]
         """
         # Challenge with the FCR
         # With Soleus we can just narrow until the mean rectified does not change by >10%
         # What do we do with FCR? - Issues of the overlap between M and H, and Stim and M
-        # So here we take the current H and M window, calculate the MeanRectified, adjust the window until MeanRectified does not vary by more than 10%
-
-        def MeanRectified(x):
-            x_mean = sum(x) / len(x)
-            return sum([abs(i - x_mean) for i in x]) / float(len(x))
+        # So here we take the current H and M window, calculate the MeanRectified, adjust the window until MeanRectified does not vary by more than 5%
+        # The end is brought in first, 1ms at a time, then the start (see FirstChange)
 
+        Data = numpy.asarray(Data, dtype=float).ravel()
+        if cumulative is None: cumulative = numpy.abs(Data).cumsum()
+        duration = len(Data) / float(self.parent.fs) - self.parent.lookback
         newInd = [ind[0], ind[1]]
-        #xMR = MeanRectified([Data[i - 1] for i in range(ind[0], ind[1] + 1)])
-        xMR = self.ResponseMagnitudes(data=Data.tolist(), interval=(ind[0], ind[1]), fs=self.parent.fs, lookback=self.parent.lookback,p2p=False,SingleTrial=True)
 
-        N = 0.001
-        NoChange = 1
-
-        while NoChange == 1:
-            x = self.ResponseMagnitudes(data=Data.tolist(), interval=(ind[0], ind[1] - N), fs=self.parent.fs, lookback=self.parent.lookback,p2p=False,SingleTrial=True)
-            #x = MeanRectified([Data[i - 1] for i in range(ind[0], ind[1] - (N - 1))])
-            if 100 * abs(1 - (x[0] / xMR[0])) > 5:
-                newInd[1] = round(ind[1] - N + 0.001,5)
-                NoChange = 0
-            else:
-                N += 0.001
+        N = self.FirstChange(Data, cumulative, reference=(ind[0], ind[1]), interval=lambda N: (ind[0], ind[1] - N), beyond=lambda N: ind[1] - N < -self.parent.lookback - 0.002)
+        newInd[1] = round(ind[1] - N + 0.001,5)
 
-        N = 0.001
-        NoChange = 1
-        #xMR = MeanRectified([Data[i - 1] for i in range(ind[0], newInd[1])])
-        xMR = self.ResponseMagnitudes(data=Data.tolist(), interval=(ind[0], newInd[1]), fs=self.parent.fs,lookback=self.parent.lookback, p2p=False,SingleTrial=True)
-        while NoChange == 1:
-            x = self.ResponseMagnitudes(data=Data.tolist(), interval=(ind[0]+N, newInd[1]), fs=self.parent.fs,lookback=self.parent.lookback, p2p=False,SingleTrial=True)
-            #x = MeanRectified([Data[i - 1] for i in range(ind[0] + (N), newInd[1])])
-            if 100 * abs(1 - (x[0] / xMR[0])) > 5:
-                newInd[0] = round(ind[0] + N - 0.001,5)
-                NoChange = 0
-            else:
-                N = N + 0.001
+        N = self.FirstChange(Data, cumulative, reference=(ind[0], newInd[1]), interval=lambda N: (ind[0] + N, newInd[1]), beyond=lambda N: ind[0] + N > duration + 0.002)
+        newInd[0] = round(ind[0] + N - 0.001,5)
 
         return newInd
 
+    def FirstChange(self,Data, cumulative, reference, interval, beyond):
+        """
+        Find the first step N (0.001, 0.002, ... s) at which the mean rectified value of Data in interval(N)
+        differs from that in the reference interval by more than 5% - called by RefineWindows
+        :param Data: a single trace
+        :param cumulative: numpy.abs(Data).cumsum()
+        :param reference: the reference interval (start,end) in seconds
+        :param interval: function returning the candidate interval for step N
+        :param beyond: function returning True once step N has gone so far that the candidate window can no longer change
+        :return: N
+
+        All the candidate windows are evaluated at once from the cumulative sums.  Those whose result is within rounding
+        error of the 5% tolerance are recomputed exactly, so the answer is the same as stepping through the windows one by one
+        with ResponseMagnitudes.
+        """
+        fs = self.parent.fs; lookback = self.parent.lookback
+        xMR = float(WindowMagnitudes(Data, WindowSlice(reference, fs, lookback, offset=0), p2p=False))
+        if xMR == 0: raise ZeroDivisionError('mean rectified value is zero in the window %r' % (reference,))
+
+        #Enumerate the candidate windows, accumulating N exactly as stepping 1ms at a time would
+        steps, starts, stops = [], [], []
+        N = 0.001
+        while not beyond(N):
+            start, stop, step = WindowSlice(interval(N), fs, lookback, offset=0).indices(len(Data))
+            if stop <= start: break #empty window: stepping one by one would have failed here
+            steps.append(N); starts.append(start); stops.append(stop)
+            N += 0.001
+
+        starts = numpy.array(starts, dtype=int); stops = numpy.array(stops, dtype=int)
+        C = numpy.concatenate(([0.0], cumulative))
+        x = (C[stops] - C[starts]) / (stops - starts)
+        change = 100 * numpy.abs(1 - (x / xMR))
+        tolerance = 100 * 4 * numpy.finfo(float).eps * len(Data) * (C[stops] + C[starts]) / (stops - starts) / xMR #bound on the rounding error of the cumulative sums
+
+        for i in numpy.flatnonzero(change > 5 - tolerance):
+            if change[i] > 5 + tolerance[i]: return steps[i]
+            x = float(WindowMagnitudes(Data, slice(starts[i], stops[i]), p2p=False))
+            if 100 * abs(1 - (x / xMR)) > 5: return steps[i]
+
+        raise ValueError('the mean rectified value never changed by more than 5%% while narrowing the window %r' % (reference,))
+
 class StimControl(object):
     """
     A heuristic control method for controlling the current during CT and TT
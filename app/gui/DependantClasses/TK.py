@@ -2,8 +2,203 @@ import matplotlib
 import Tkinter as tkinter
 try: import ttk
 except ImportError: import Tix; tksuperclass = Tix.Tk  # ...because Python 2.5 does not have ttk. Included for legacy compatibility:  this GUI was originally developed under Python 2.5.4 without ttk, but has now transitioned to Python 2.7.5 with ttk
-import sys
-from CoreFunctions import Bunch, FixAspectRatio
+import sys, types, traceback, cPickle, cStringIO, Queue, multiprocessing
+import numpy
+import matplotlib.ticker, matplotlib.backend_bases
+from CoreFunctions import Bunch, IndexedBunch, FixAspectRatio
+
+
+class RenderServer( object ):
+	"""
+	Renders matplotlib figures into Agg RGBA buffers in a separate process, so that a slow
+	redraw of an analysis figure does not hold up the Tk main loop, and with it the live
+	feedback on the main GUI tabs.  Only plain data passes between the processes:  the Tk
+	thread pickles a snapshot of the figure (see Snapshot()), the render process (see
+	RenderProcess()) draws its own copy, and sends back the pixels, which Poll() copies
+	into the canvas's PhotoImage on the Tk thread -- the same blit that
+	FigureCanvasTkAgg.draw() itself does at the end.  No matplotlib object is ever used by
+	more than one thread.
+
+	Adopt() a FigureCanvasTkAgg and its draw() (and show(), in matplotlib versions that
+	have it) will only Request() a render.  Each canvas has at most one render in flight:
+	requests made in the meantime are coalesced into one, which is sent when the pending
+	result arrives, and that result is then dropped as stale.  A result is also dropped if
+	the canvas has been resized since the request.  If a figure cannot be pickled or
+	rendered, or the render process has died, the canvas is released:  it goes back to
+	drawing on the Tk thread, as if it had never been adopted.
+
+	Only one RenderServer is needed:  use Shared().
+	"""
+	shared = None
+	@classmethod
+	def Shared( cls ):
+		if cls.shared == None: cls.shared = cls()
+		return cls.shared
+
+	@staticmethod
+	def Available():
+		"""
+		Return True if the pixels of a render can be blitted into a Tk PhotoImage:  this
+		needs the tkagg.blit() of matplotlib 1.5 to 2.x, which accepts any RGBA array.
+		"""
+		try: import matplotlib.backends.backend_tkagg
+		except ImportError: return False
+		tkagg = getattr( matplotlib.backends.backend_tkagg, 'tkagg', None )
+		return hasattr( tkagg, 'blit' ) and matplotlib.__version__ >= '1.5'
+
+	def __init__( self, interval=10 ):
+		self.interval = interval   # milliseconds between polls while renders are outstanding
+		self.adopted = {}          # id( canvas ): Bunch( canvas, inFlight, pending )
+		self.polling = False
+		self.requests = multiprocessing.Queue()
+		self.results = multiprocessing.Queue()
+		self.process = multiprocessing.Process( target=RenderProcess, args=( self.requests, self.results ) )
+		self.process.daemon = True
+		self.process.start()
+
+	def Adopt( self, canvas ):
+		"""
+		Make <canvas> (a FigureCanvasTkAgg) render via the render process from now on.
+		"""
+		if not self.Available() or not self.process.is_alive(): return False
+		for key, entry in self.adopted.items(): # forget the canvases of windows that have been closed
+			try: exists = entry.canvas.get_tk_widget().winfo_exists()
+			except tkinter.TclError: exists = False
+			if not exists: del self.adopted[ key ]
+		self.adopted[ id( canvas ) ] = Bunch( canvas=canvas, inFlight=False, pending=False )
+		canvas.draw = lambda: self.Request( canvas )
+		if hasattr( canvas, 'show' ): canvas.show = canvas.draw
+		return True
+
+	def Release( self, canvas, reason=None ):
+		"""
+		Give <canvas> its own draw() back, and draw it.
+		"""
+		self.adopted.pop( id( canvas ), None )
+		for name in [ 'draw', 'show' ]: canvas.__dict__.pop( name, None )
+		if reason: sys.stderr.write( 'figure rendering moved back to the Tk thread: %s\n' % reason )
+		try: canvas.draw()
+		except tkinter.TclError: pass # window closed in the meantime
+
+	def Request( self, canvas ):
+		"""
+		Called on the Tk thread instead of canvas.draw().
+		"""
+		entry = self.adopted.get( id( canvas ) )
+		if entry == None: return self.Release( canvas )
+		if entry.inFlight: entry.pending = True; return
+		if not self.process.is_alive(): return self.Release( canvas, 'the render process has stopped' )
+		try: snapshot = Snapshot( canvas.figure )
+		except Exception: return self.Release( canvas, traceback.format_exc() )
+		self.requests.put( ( id( canvas ), snapshot ) )
+		entry.inFlight = True
+		entry.pending = False
+		if not self.polling:
+			root = canvas.get_tk_widget()._root() # rather than the canvas widget itself, whose window may be closed before the render finishes
+			try: root.after( self.interval, self.Poll, root )
+			except tkinter.TclError: return
+			self.polling = True
+
+	def Poll( self, root ):
+		"""
+		Show whatever has finished rendering, on the Tk thread.  Renews its own schedule as
+		long as there is work outstanding.
+		"""
+		self.polling = False
+		while True:
+			try: key, result = self.results.get_nowait()
+			except Queue.Empty: break
+			entry = self.adopted.get( key )
+			if entry == None: continue # released or closed in the meantime
+			entry.inFlight = False
+			if isinstance( result, basestring ): self.Release( entry.canvas, result )
+			elif entry.pending: self.Request( entry.canvas ) # the result is already out of date
+			else: self.Show( entry.canvas, *result )
+		outstanding = [ entry.canvas for entry in self.adopted.values() if entry.inFlight ]
+		if outstanding and not self.process.is_alive():
+			for canvas in outstanding: self.Release( canvas, 'the render process has stopped' )
+		elif outstanding and not self.polling:
+			try: root.after( self.interval, self.Poll, root ); self.polling = True
+			except tkinter.TclError: pass
+
+	def Show( self, canvas, width, height, pixels ):
+		photo = canvas._tkphoto
+		try:
+			if int( photo.width() ) != width or int( photo.height() ) != height: return # resized since: the resize itself will have made a new request
+			pixels = numpy.fromstring( pixels, dtype=numpy.uint8 ).reshape( height, width, 4 )
+			matplotlib.backends.backend_tkagg.tkagg.blit( photo, pixels, colormode=2 )
+			canvas.get_tk_widget().update_idletasks()
+		except tkinter.TclError: self.adopted.pop( id( canvas ), None ) # window closed in the meantime
+
+NATIVE = ( 'matplotlib', 'mpl_toolkits', 'numpy', '__builtin__', 'copy_reg', 'collections', 'functools', 'weakref', 'datetime', 'cycler', 'six' )
+def Native( thing ):
+	"""
+	Return True if <thing> (a class or function) comes from matplotlib, or from one of the
+	modules it relies on, so that the render process can unpickle it.
+	"""
+	module = getattr( thing, '__module__', None ) or ''
+	return module.split( '.' )[ 0 ] in NATIVE
+
+def Snapshot( figure ):
+	"""
+	Return a pickled copy of <figure> for RenderProcess(), made on the Tk thread.  Anything
+	that is not native to matplotlib (see Native()), such as Tk widgets, bound methods or
+	the GUI's own selectors and controllers that may be attached to the figure's artists,
+	is left out of the copy:  none of it is needed for drawing.  The one exception is tick
+	formatting by a FuncFormatter whose function is not native (e.g. that of an
+	AxisController):  its labels are computed here and sent as a FixedFormatter.
+	"""
+	def persistent_id( obj ):
+		if isinstance( obj, matplotlib.ticker.FuncFormatter ) and not Native( obj.func ): return ( 'labels', FixedLabels( obj ) )
+		if isinstance( obj, types.MethodType ): return 'omitted'
+		if isinstance( obj, ( types.FunctionType, type, types.ClassType ) ): return None if Native( obj ) else 'omitted'
+		if isinstance( obj, ( tkinter.Misc, matplotlib.backend_bases.FigureCanvasBase ) ) or not Native( getattr( obj, '__class__', type( obj ) ) ): return 'omitted'
+		return None
+	buffer = cStringIO.StringIO()
+	pickler = cPickle.Pickler( buffer, 2 )
+	pickler.persistent_id = persistent_id
+	pickler.dump( figure )
+	return buffer.getvalue()
+
+def FixedLabels( formatter ):
+	"""
+	Return a FixedFormatter with the labels that <formatter> would give the current ticks.
+	"""
+	axis = formatter.axis
+	if formatter is axis.major.formatter: locs = axis.major.locator()
+	else: locs = axis.minor.locator()
+	formatter.set_locs( locs )
+	return matplotlib.ticker.FixedFormatter( [ formatter( x, i ) for i, x in enumerate( locs ) ] )
+
+def RenderProcess( requests, results ):
+	"""
+	The target of the process started by RenderServer:  unpickle each figure snapshot from
+	the <requests> queue, draw it with Agg, and put its pixels (or a traceback) on the
+	<results> queue.
+	"""
+	import matplotlib.pyplot, matplotlib._pylab_helpers
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	inherited = dict( matplotlib._pylab_helpers.Gcf.figs ) # if the process was forked, it holds copies of the Tk figures, which must be neither drawn nor destroyed here
+	matplotlib._pylab_helpers.Gcf.figs.clear()
+	matplotlib.pyplot.switch_backend( 'Agg' ) # so that snapshots of pyplot figures are restored to pyplot without a window
+	def persistent_load( pid ):
+		if isinstance( pid, tuple ) and pid[ 0 ] == 'labels': return pid[ 1 ]
+		return None
+	while True:
+		item = requests.get()
+		if item is None: break
+		key, snapshot = item
+		try:
+			unpickler = cPickle.Unpickler( cStringIO.StringIO( snapshot ) )
+			unpickler.persistent_load = persistent_load
+			figure = unpickler.load()
+			canvas = FigureCanvasAgg( figure )
+			canvas.draw()
+			pixels = numpy.asarray( canvas.get_renderer()._renderer )
+			result = ( pixels.shape[ 1 ], pixels.shape[ 0 ], pixels.tostring() )
+		except Exception: result = traceback.format_exc()
+		matplotlib.pyplot.close( 'all' )
+		results.put( ( key, result ) )
 
 
 class TkMPL( object ):
@@ -11,7 +206,9 @@ class TkMPL( object ):
 	This is a general class that allows you to keep track of a lot of Tkinter widgets
 	(in a Bunch() called self.widgets) and a lot of matplotlib artists (in a Bunch()
 	called self.artists).  Subsets of them can be retrieved by the MatchWidgets() and
-	MatchArtists() methods.
+	MatchArtists() methods.  Both are IndexedBunch() instances, which keep track of the
+	specifiers in their keys so that these lookups stay cheap however many elements
+	have been registered.
 
 	The convention is to use the Bunch() key to code a number of different specifiers,
 	delimited by underscores. Typically this will be a location or context, followed by
@@ -30,14 +227,18 @@ class TkMPL( object ):
 	include NewFigure() as mentioned above,  DrawFigures() for refreshing/redrawing all
 	(or a subset of) the handles that can be retrieved by self.MatchArtists( 'figure' );
 	and several helper methods for creating and manipulating tabbed panes in the GUI.
+	Subclasses that set offThreadRendering = True have their figures rendered by the
+	shared RenderServer, in a separate process, instead of on the Tk thread.
 
 	The TkMPL class is an abstract class, used as superclass for the main GUI() class,
 	as well as the AnalysisWindow() and SettingsWindow(), and also the InfoItem() helper
 	class.
 	"""
+	offThreadRendering = False
+
 	def __init__( self ):
-		self.artists = Bunch()
-		self.widgets = Bunch()
+		self.artists = IndexedBunch()
+		self.widgets = IndexedBunch()
 		self.colors = Bunch(  # also define the colour-scheme.  Note that HTML-style colour strings are accepted by both Tkinter and matplotlib, so let's stick to that format
 			           figure = '#CCCCCC',
 			               bg = '#CCCCCC',
@@ -61,6 +262,9 @@ class TkMPL( object ):
 		"""
 		Helper function for MatchArtists() and MatchWidgets()
 		"""
+		if isinstance( things, IndexedBunch ):
+			keys = things.Lookup( *terms )
+			return keys, [ things[ key ] for key in keys ]
 		keys = []
 		matches = []
 		for key, thing in things.items():
@@ -126,6 +330,7 @@ class TkMPL( object ):
 		self.artists[ name ] = fig
 		self.widgets[ name ] = widget
 		fig.subplots_adjust( bottom=0.06, top=0.94, right=0.92 )
+		if self.offThreadRendering: RenderServer.Shared().Adopt( fig.canvas )
 		return fig, widget, container
 
 	def MakeNotebook( self, parent=None, name='notebook' ):
@@ -67,10 +67,11 @@ TODO
 """
 
 import Tkinter as tkinter
-import os, re, struct, sys, mmap, inspect
+import os, re, struct, sys, mmap, inspect, timeit, traceback, Queue, multiprocessing
 
 import matplotlib.pyplot   # this is the online GUI's only non-bundled third-party dependency besides Python itself (although implicitly, matplotlib in turn also requires numpy)
-from collections import OrderedDict
+import numpy
+from collections import OrderedDict, deque
 
 tksuperclass = tkinter.Tk
 import imp
@@ -162,6 +163,658 @@ EPOCSVERSIONDATE = "2-21-19"
 #This calls CoreFunctions so no need to do import it
 from DependantClasses.CoreGUIcomponents import *
 
+class StateIndex( object ):
+    """
+    Maps the names of the State variables in a SampleBlock to their positions, as an
+    attribute per State variable (e.g. index.TrialsCompleted is an int).  One is made per
+    run, from the State-name line in shared memory, and is shared by every StateVector of
+    that run, so code that reads the same State variables block after block can look
+    their positions up once and then index the values directly.
+    """
+    def __init__( self, names ):
+        self.__dict__.update( ( name, position ) for position, name in enumerate( names ) )
+        self._names = tuple( names )
+
+    def Names( self ): return self._names
+
+class StateVector( object ):
+    """
+    The State variable values of one SampleBlock: a read-only float64 numpy array plus a
+    reference to the run's StateIndex.  Values can be read by precomputed position, via
+    Values()[ position ], or (more slowly) by name, either as attributes or through a
+    minimal read-only dict interface (get(), keys(), items(), [ name ], in, len()).
+    Changed() compares two blocks' values all at once.
+    """
+    __slots__ = ( '_index', '_values' )
+
+    def __init__( self, index, values ):
+        values = numpy.array( values, dtype=numpy.float64 )
+        values.flags.writeable = False
+        object.__setattr__( self, '_index', index )
+        object.__setattr__( self, '_values', values )
+
+    def Index( self ): return self._index
+    def Values( self ): return self._values
+
+    def Changed( self, previous ):
+        """
+        Return a boolean numpy array, aligned with Values(), that is True wherever the value
+        differs from that of the <previous> StateVector (everywhere, if there is no
+        comparable previous block).
+        """
+        if not isinstance( previous, StateVector ) or previous._index is not self._index:
+            return numpy.ones( self._values.shape, dtype=bool )
+        return self._values != previous._values
+
+    def __getattr__( self, name ):
+        if name.startswith( '_' ): raise AttributeError( name )
+        try: return float( self._values[ getattr( self._index, name ) ] )
+        except AttributeError: raise AttributeError( "'%s' object has no attribute or State variable '%s'" % ( self.__class__.__name__, name ) )
+    def __setattr__( self, name, value ): raise AttributeError( "'%s' object is read-only" % self.__class__.__name__ )
+    def __getitem__( self, name ):
+        try: return getattr( self, name )
+        except AttributeError: raise KeyError( name )
+    def get( self, name, default=None ):
+        try: return getattr( self, name )
+        except AttributeError: return default
+    def keys( self ): return list( self._index.Names() )
+    def items( self ): return zip( self._index.Names(), self._values.tolist() )
+    def __contains__( self, name ): return name in self._index.Names()
+    def __iter__( self ): return iter( self._index.Names() )
+    def __len__( self ): return len( self._values )
+
+class SharedMemoryLayout( object ):
+    """
+    Decoded description of the shared-memory area written by the C++ function
+    SharedMemoryOutputConnector::Write() (see Operator.ReadMM() for the protocol).
+    Construct one from an mmap.mmap instance at the start of a run: the header
+    is unpacked once, the State variable names are parsed once, and numpy views
+    of the signal and State-value regions are created straight over the mapped
+    memory.  The views always reflect the current contents of shared memory, so
+    anything that needs to outlive the current SampleBlock must be copied out of
+    them.
+    """
+    headerFormat = '@LLLL'
+
+    def __init__( self, mm ):
+        self.headerSize = struct.calcsize( self.headerFormat )
+        counter, self.nChannels, self.nElements, self.nStates = struct.unpack( self.headerFormat, mm[ :self.headerSize ] )
+        itemSize = numpy.dtype( numpy.float64 ).itemsize
+        self.signalOffset = self.headerSize
+        self.statesOffset = self.signalOffset + itemSize * self.nChannels * self.nElements
+        self.namesOffset = self.statesOffset + itemSize * self.nStates
+        end = mm.find( '\n', self.namesOffset )
+        if end < 0: end = len( mm )
+        self.stateNames = mm[ self.namesOffset:end ].strip().split( ' ' )
+        self.stateIndex = StateIndex( self.stateNames )
+        self.signal = numpy.frombuffer( mm, dtype=numpy.float64, count=self.nChannels * self.nElements, offset=self.signalOffset ).reshape( self.nChannels, self.nElements )
+        self.states = numpy.frombuffer( mm, dtype=numpy.float64, count=self.nStates, offset=self.statesOffset )
+
+class BlockQueue( object ):
+    """
+    A bounded first-in, first-out queue of decoded SampleBlocks.  GUI.WatchMM() Put()s every
+    block it reads from shared memory, from its own thread; GUI.HandlePendingTasks() takes
+    them all out again, in order, on the Tk thread.  So a block can never be overwritten by
+    its successor just because the Tk thread was busy (e.g. redrawing a figure) when it
+    arrived.
+
+    If the queue is ever full, room is made by discarding the oldest block that was not
+    marked as important (WatchMM() marks the blocks in which TrialsCompleted changes).
+    Only if every waiting block is important is the oldest one discarded regardless.
+    Either way, the event is counted: see Overflows() and Summary().
+    """
+    def __init__( self, depth=256 ):
+        self.lock = threading.Lock()
+        self.blocks = deque()
+        self.Reset( depth )
+
+    def Reset( self, depth=None ):
+        """
+        Empty the queue, zero the counters, and optionally change the maximum <depth>.
+        """
+        self.lock.acquire()
+        if depth != None: self.depth = max( 1, int( depth ) )
+        self.blocks.clear()
+        self.received = 0
+        self.dropped = 0
+        self.droppedImportant = 0
+        self.maxLength = 0
+        self.reported = 0
+        self.lock.release()
+
+    def Put( self, block, important=False ):
+        """
+        Append <block> to the end of the queue, making room first if necessary.
+        """
+        self.lock.acquire()
+        try:
+            self.received += 1
+            if len( self.blocks ) >= self.depth:
+                self.dropped += 1
+                for index, ( waitingImportance, waitingBlock ) in enumerate( self.blocks ):
+                    if not waitingImportance: del self.blocks[ index ]; break
+                else:
+                    self.blocks.popleft()
+                    self.droppedImportant += 1
+            self.blocks.append( ( important, block ) )
+            self.maxLength = max( self.maxLength, len( self.blocks ) )
+        finally:
+            self.lock.release()
+
+    def GetAll( self ):
+        """
+        Remove and return all the waiting blocks, as a list in order of arrival.
+        """
+        self.lock.acquire()
+        try:
+            blocks = [ block for important, block in self.blocks ]
+            self.blocks.clear()
+        finally:
+            self.lock.release()
+        return blocks
+
+    def Overflows( self ):
+        """
+        Return the number of blocks discarded since the last call (or since Reset()).
+        """
+        self.lock.acquire()
+        n = self.dropped - self.reported
+        self.reported = self.dropped
+        self.lock.release()
+        return n
+
+    def Summary( self ):
+        return '%d of %d SampleBlocks discarded (%d of them marking new trials); maximum queue length %d of %d' % ( self.dropped, self.received, self.droppedImportant, self.maxLength, self.depth )
+
+class WatcherStatistics( object ):
+    """
+    Keeps count of how well GUI.WatchMM() is anticipating the arrival of each SampleBlock.
+    The "wake-to-block lag" is the time between the watcher waking up from its sleep and
+    its first sight of the new block.  If the block is already there when the watcher wakes,
+    the wakeup counts as late (and its lag as zero): the block may have been waiting for
+    anything up to the length of the sleep.
+    """
+    def __init__( self, mode='latency' ):
+        self.Reset( mode )
+
+    def Reset( self, mode=None ):
+        if mode != None: self.mode = mode
+        self.blocks = 0
+        self.late = 0
+        self.totalLag = 0.0
+        self.maxLag = 0.0
+        self.recentLags = deque( maxlen=1000 )
+
+    def Add( self, lag, late ):
+        self.blocks += 1
+        if late: self.late += 1
+        self.totalLag += lag
+        self.maxLag = max( self.maxLag, lag )
+        self.recentLags.append( lag )
+
+    def Summary( self ):
+        if not self.blocks: return 'shared-memory watcher (%s-first): no SampleBlocks timed' % self.mode
+        recent = sorted( self.recentLags )
+        return 'shared-memory watcher (%s-first): wake-to-block lag mean %.2f msec, median %.2f msec, max %.2f msec; %d of %d wakeups late' % ( self.mode, 1000.0 * self.totalLag / self.blocks, 1000.0 * recent[ len( recent ) // 2 ], 1000.0 * self.maxLag, self.late, self.blocks )
+
+class LatencyProfile( object ):
+    """
+    Accumulates, over one run, the end-to-end latency of each SampleBlock's journey from
+    BCI2000 to the screen.  Every interval is measured from the moment GUI.WatchMM() sees
+    the shared-memory counter change, to the end of each of the following stages:
+        decode:   Operator.ReadMM() has returned the decoded block;
+        dequeue:  GUI.HandlePendingTasks() has taken the block out of the BlockQueue;
+        incoming: GUI.ProcessStatesAndSignal() (and hence GUI.Incoming()) has finished
+                  with the block;
+        draw:     the first redraw (by GUI.redraws, a RedrawScheduler) of a figure that
+                  was flagged on account of the block has finished (blocks that flagged no
+                  figure contribute no sample).
+    In addition, the duration of every redraw of every figure is recorded by AddFrame().
+    All timestamps come from timeit.default_timer.  The samples are kept (in ScalarStore
+    instances) until the next Reset(), so any percentile can be queried after the run.
+    For example, from the interactive prompt of a debugging session:
+        self.latency.Report()               # a Bunch of Bunches: n, p50, p95, p99, max (msec)
+        self.latency.Percentile( 'draw', 90 )
+    A summary is written to the log by GUI.Stop().
+    """
+    stages = ( 'decode', 'dequeue', 'incoming', 'draw' )
+
+    def __init__( self ):
+        self.Reset()
+
+    def Reset( self ):
+        self.samples = Bunch( ( stage, ScalarStore() ) for stage in self.stages )
+        self.frames = Bunch()
+
+    def Add( self, start, **stamps ):
+        """
+        Record, for each <stage>=<timestamp> keyword argument, the time elapsed since <start>.
+        """
+        for stage, timestamp in stamps.items(): self.samples[ stage ].append( timestamp - start )
+
+    def AddFrame( self, name, seconds ):
+        """
+        Record the time taken to redraw the figure called <name>.
+        """
+        if name not in self.frames: self.frames[ name ] = ScalarStore()
+        self.frames[ name ].append( seconds )
+
+    def Percentile( self, stage, q ):
+        """
+        Return the <q>th percentile of the latency of the named <stage>, in milliseconds
+        (or None if there are no samples).
+        """
+        values = self.samples[ stage ].values()
+        if not len( values ): return None
+        return 1000.0 * numpy.percentile( values, q )
+
+    def Statistics( self, values ):
+        values = numpy.asarray( values )
+        if not len( values ): return Bunch( n=0 )
+        p50, p95, p99, pmax = 1000.0 * numpy.percentile( values, [ 50, 95, 99, 100 ] )
+        return Bunch( n=len( values ), p50=p50, p95=p95, p99=p99, max=pmax )
+
+    def Report( self ):
+        report = Bunch( ( stage, self.Statistics( self.samples[ stage ] ) ) for stage in self.stages )
+        report.frames = Bunch( ( name, self.Statistics( values ) ) for name, values in self.frames.items() )
+        return report
+
+    def Summary( self ):
+        report = self.Report()
+        lines = [ 'SampleBlock latency from shared-memory counter change (msec):' ]
+        for stage in self.stages:
+            r = report[ stage ]
+            if r.n: lines.append( '    to end of %-9s  p50 %7.2f   p95 %7.2f   p99 %7.2f   max %7.2f   (n=%d)' % ( stage + ':', r.p50, r.p95, r.p99, r.max, r.n ) )
+            else: lines.append( '    to end of %-9s  no samples' % ( stage + ':' ) )
+        if len( report.frames ): lines.append( 'Redraw durations (msec):' )
+        for name, r in sorted( report.frames.items() ):
+            lines.append( '    %-20s  p50 %7.2f   p95 %7.2f   p99 %7.2f   max %7.2f   (n=%d)' % ( name + ':', r.p50, r.p95, r.p99, r.max, r.n ) )
+        return '\n'.join( lines )
+
+class RedrawScheduler( object ):
+    """
+    Keeps track of the matplotlib figures that need to be redrawn, and redraws them on
+    behalf of GUI.HandlePendingTasks().  However many times a figure is Flag()ged before
+    it is next drawn, it is drawn only once.  Each figure can be Configure()d with:
+        name:        identifies the figure in the frame-time statistics;
+        priority:    figures with lower numbers are drawn first, so that if Draw() is given
+                     a time budget that runs out, the feedback displays have been drawn
+                     already (the others stay flagged until the next call);
+        minInterval: the figure is drawn at most once every <minInterval> seconds (it
+                     stays flagged in the meantime);
+        blitter:     a Blitter instance, for a figure whose changing artists can be
+                     updated by blitting.
+    Figures that have not been configured get the settings in self.defaults.
+
+    A figure is flagged either for a full redraw (the default) or, if it has a Blitter,
+    for blitting only (blit=True). A full redraw takes precedence. The duration of each
+    redraw is passed to <frameCallback>( name, seconds ), if supplied.
+
+    A Flag() may also name its <origin> (in practice, the time at which the SampleBlock
+    responsible was detected).  When a figure is drawn, each of its origins is reported,
+    together with the time the drawing finished, by the next call to Drawn() -- once only,
+    even if the same origin flagged several figures.
+    """
+    def __init__( self, frameCallback=None, priority=10, minInterval=0.2 ):
+        self.defaults = Bunch( priority=priority, minInterval=minInterval, blitter=None )
+        self.frameCallback = frameCallback
+        self.settings = {}
+        self.dirty = OrderedDict()
+        self.lastDrawn = {}
+        self.drawnOrigins = OrderedDict()
+
+    def Configure( self, figure, **settings ):
+        self.settings[ figure ] = self.Settings( figure ).update( settings )
+
+    def Settings( self, figure ):
+        settings = self.settings.get( figure, None )
+        if settings == None: settings = Bunch( self.defaults, name='figure %d' % figure.number )
+        return settings
+
+    def Flag( self, figure, key='base', blit=False, origin=None ):
+        """
+        Flag <figure> as needing to be redrawn (or only blitted, if blit=True).  The <key>
+        is a hint about what has changed (see NewTrial()): 'base', 'SignalAvg', 'Sequence'...
+        """
+        entry = self.dirty.get( figure, None )
+        if entry == None: entry = self.dirty[ figure ] = Bunch( full=False, key=key, origins=set() )
+        if not blit: entry.full = True; entry.key = key
+        if origin != None: entry.origins.add( origin )
+
+    def Pending( self ):
+        return len( self.dirty )
+
+    def Drawn( self ):
+        """
+        Return, and forget, a list of ( origin, finishedTime ) pairs, one for each origin
+        whose first figure has been drawn since the last call.
+        """
+        drawn = list( self.drawnOrigins.items() )
+        self.drawnOrigins.clear()
+        return drawn
+
+    def Forget( self, *figures ):
+        """
+        Unflag the specified <figures> and forget their settings:  call this when the
+        window that contains them is closed, so that they are not drawn after their
+        canvases have been destroyed.
+        """
+        for figure in figures:
+            self.dirty.pop( figure, None )
+            self.settings.pop( figure, None )
+            self.lastDrawn.pop( figure, None )
+
+    def Draw( self, budget=None, maxPriority=None ):
+        """
+        Redraw the flagged figures that are due, in order of priority.  If a <budget> (in
+        seconds) is given, stop once it has been used up (but always draw at least one
+        figure).  If <maxPriority> is given, leave figures with higher numbers flagged.
+        Return the list of figures drawn.  A figure whose canvas turns out to have been
+        destroyed is forgotten (see Forget()) rather than drawn.
+        """
+        clock = timeit.default_timer
+        start = clock()
+        due = [ figure for figure in self.dirty if start - self.lastDrawn.get( figure, -numpy.inf ) >= self.Settings( figure ).minInterval ]
+        if maxPriority != None: due = [ figure for figure in due if self.Settings( figure ).priority <= maxPriority ]
+        due.sort( key=lambda figure: self.Settings( figure ).priority )
+        drawn = []
+        for figure in due:
+            if budget != None and len( drawn ) and clock() - start >= budget: break
+            entry = self.dirty.pop( figure )
+            settings = self.Settings( figure )
+            t0 = clock()
+            try:
+                if entry.full or settings.blitter == None: figure.canvas.draw()
+                else: settings.blitter.Update()
+            except tkinter.TclError: # its window was closed without calling Forget()
+                self.Forget( figure )
+                continue
+            t1 = self.lastDrawn[ figure ] = clock()
+            if entry.origins:
+                for origin in entry.origins: self.drawnOrigins[ origin ] = t1
+                for other in self.dirty.values(): other.origins -= entry.origins # each origin is reported only for the first figure it flagged
+            ###AMIR the M-wave analysis window's signal average and sequence figures are drawn on top of (hold=True) the existing plots
+            if entry.key == 'SignalAvg': figure.hold( False )
+            elif entry.key == 'Sequence': figure.hold( True )
+            if self.frameCallback: self.frameCallback( settings.name, t1 - t0 )
+            drawn.append( figure )
+        return drawn
+
+class Subscription( object ):
+    """
+    One consumer's registration with a MessageBus (see MessageBus.Subscribe()).
+    """
+    def __init__( self, topic, name, callback, priority=0, minInterval=0.0, depth=None, synchronous=False ):
+        self.topic = topic
+        self.name = name
+        self.callback = callback
+        self.priority = priority
+        self.minInterval = minInterval
+        self.synchronous = synchronous
+        self.queue = deque( maxlen=depth )
+        self.Reset()
+
+    def Reset( self ):
+        self.queue.clear()
+        self.lastDelivery = None
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def Due( self, now ):
+        if not len( self.queue ): return False
+        return self.lastDelivery == None or now - self.lastDelivery >= self.minInterval
+
+    def Deliver( self, messages, now, bus=None ):
+        """
+        Pass each of <messages> to the callback.  An exception raised by the callback is
+        counted in self.failed and reported (via bus.errorCallback, if there is one) but goes
+        no further, so that it costs neither the remaining messages nor other subscribers.
+        """
+        self.lastDelivery = now
+        for message in messages:
+            self.delivered += 1
+            if bus != None: bus.current = message
+            try: self.callback( message )
+            except Exception:
+                self.failed += 1
+                if bus != None and bus.errorCallback != None: bus.errorCallback( self, message )
+                else: traceback.print_exc()
+            finally:
+                if bus != None: bus.current = None
+
+class MessageBus( object ):
+    """
+    A small in-process publish/subscribe mechanism.  The GUI publishes each decoded
+    SampleBlock once, on the 'block' topic, and each completed trial once, on the 'trial'
+    topic.  Each message is a Bunch whose numpy arrays have been made read-only, so that
+    the same message can safely be handed to every consumer without copying.
+
+    Consumers subscribe with their own delivery policy:
+        synchronous: the callback is called immediately, inside Publish().  Use this for
+                     consumers that must see every message, in order, before anything else
+                     happens (e.g. storing the trial, or automated current control);
+        depth:       otherwise, messages wait in a per-subscriber queue of this maximum
+                     length (None means unlimited; 1 means only the latest message matters)
+                     until Deliver() is called. Messages that fall off the front of a full
+                     queue are counted as dropped;
+        minInterval: a queued subscriber receives its messages at most once every
+                     <minInterval> seconds;
+        priority:    in Deliver(), subscribers are served in ascending order of priority, so
+                     a slow, low-priority consumer (e.g. an analysis panel) is always served
+                     after, and therefore never delays, a high-priority one (e.g. the feedback
+                     bars).
+
+    If a callback raises an exception, <errorCallback> is called with the subscription and
+    the message, while the exception is being handled, and delivery carries on.
+    """
+    def __init__( self, errorCallback=None ):
+        self.subscriptions = []
+        self.errorCallback = errorCallback
+        self.current = None # the message whose callback is running, if any
+
+    def Subscribe( self, topic, name, callback, priority=0, minInterval=0.0, depth=None, synchronous=False ):
+        """
+        Register <callback> to receive messages published on <topic>, replacing any
+        existing subscription with the same <topic> and <name>.
+        """
+        self.Unsubscribe( topic, name )
+        subscription = Subscription( topic=topic, name=name, callback=callback, priority=priority, minInterval=minInterval, depth=depth, synchronous=synchronous )
+        self.subscriptions.append( subscription )
+        self.subscriptions.sort( key=lambda x: x.priority )
+        return subscription
+
+    def Unsubscribe( self, topic, name ):
+        self.subscriptions = [ x for x in self.subscriptions if ( x.topic, x.name ) != ( topic, name ) ]
+
+    def Publish( self, topic, **fields ):
+        """
+        Package <fields> as a read-only message and pass it to every subscriber to <topic>.
+        """
+        for value in fields.values():
+            if isinstance( value, numpy.ndarray ): value.flags.writeable = False
+        message = Bunch( topic=topic, time=time.time(), **fields )
+        now = time.time()
+        for subscription in list( self.subscriptions ):
+            if subscription.topic != topic: continue
+            subscription.received += 1
+            if subscription.synchronous:
+                subscription.Deliver( [ message ], now, bus=self )
+            else:
+                if subscription.queue.maxlen != None and len( subscription.queue ) == subscription.queue.maxlen: subscription.dropped += 1
+                subscription.queue.append( message )
+        return message
+
+    def Deliver( self, maxPriority=None, deadline=None ):
+        """
+        Serve every queued subscriber that is due, in order of priority.  If <maxPriority>
+        is given, only subscribers with that priority or a lower number are served.  If a
+        <deadline> (in timeit.default_timer() seconds) is given, stop once it has passed.
+        Either way, the messages of subscribers that were not served stay queued.
+        """
+        now = time.time()
+        for subscription in list( self.subscriptions ):
+            if maxPriority != None and subscription.priority > maxPriority: break
+            if deadline != None and timeit.default_timer() >= deadline: break
+            if not subscription.Due( now ): continue
+            messages = list( subscription.queue )
+            subscription.queue.clear()
+            subscription.Deliver( messages, now, bus=self )
+
+    def Queued( self ):
+        """
+        Return the number of subscribers that have messages waiting.
+        """
+        return sum( [ len( subscription.queue ) > 0 for subscription in self.subscriptions ] )
+
+    def Reset( self ):
+        """
+        Discard all queued messages and zero the counters.
+        """
+        for subscription in self.subscriptions: subscription.Reset()
+
+class TrialJournal( object ):
+    """
+    An append-only, memory-mapped record of the trials of the current run, so that the
+    stored trials and the per-trial analysis values survive a crash of the GUI process.
+
+    Append() only places the trial in a bounded queue: a background thread writes it to
+    the journal file, so the Tk thread never waits for the disk. (If the queue is full,
+    the trial is not journaled, and is counted in self.dropped.)
+
+    The file consists of a fixed-size header (see headerFormat) followed by one record
+    per trial.  Each record is a sequence of float64 numbers: first the values named in
+    self.metrics, then the signal (channel by channel).  The record count in the header
+    is only incremented after the record itself has been written, so the file is
+    consistent at all times.  Because the file is mapped into memory, everything that has
+    been written survives the termination of the process (the operating system will
+    still write back the pages) even though nothing is flushed explicitly until Close().
+    Close() also sets the header's "closed" flag: a journal whose flag is not set belongs
+    to a run that was interrupted, and its contents can be reloaded with Read().
+    """
+    magic = 'EPOCSJ01'
+    headerFormat = '<8sLLLLdd4s12s' # magic, closed, nRecords, nChannels, nSamples, fs, lookback, mode, run
+    headerSize = 64
+    metrics = ( 'TrialsCompleted', 'HwaveMag', 'MwaveMag', 'BGmag', 'CurrentAmplitude' )
+
+    def __init__( self, depth=1024, timeout=5.0 ):
+        self.depth = depth
+        self.timeout = timeout # seconds that Close() waits for the writer thread
+        self.queue = None
+        self.thread = None
+        self.output = None # the file and mmap of the current journal, once Writer() has opened them
+        self.filename = None
+        self.written = 0
+        self.dropped = 0
+
+    def Open( self, filename, mode, run, fs, lookback ):
+        """
+        Start a new journal at <filename>, replacing any previous one there.
+        """
+        self.Close()
+        self.filename = filename
+        self.written = 0
+        self.dropped = 0
+        self.queue = Queue.Queue( maxsize=self.depth )
+        self.output = Bunch( file=None, mm=None )
+        self.thread = threading.Thread( target=self.Writer, args=( self.queue, self.output, filename, mode, run, fs, lookback ) )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Append( self, signal, **metrics ):
+        """
+        Queue one trial's <signal> (nChannels x nSamples) and the values named in self.metrics
+        (any that are not supplied are recorded as NaN) to be written to the journal.
+        """
+        if self.queue == None: return
+        record = [ metrics.get( name, numpy.nan ) for name in self.metrics ]
+        try: self.queue.put_nowait( ( numpy.asarray( signal, dtype=numpy.float64 ), record ) )
+        except Queue.Full: self.dropped += 1
+
+    def Close( self ):
+        """
+        Wait (up to self.timeout seconds) for all queued trials to be written, then mark the
+        journal as closed.  If the writer thread has died, the journal is closed directly.
+        """
+        if self.queue == None: return
+        if self.thread.is_alive():
+            try: self.queue.put( None, timeout=self.timeout )
+            except Queue.Full: pass
+            self.thread.join( self.timeout )
+        if not self.thread.is_alive(): self.Seal( self.output )
+        self.queue = None
+        self.thread = None
+        self.output = None
+
+    def Seal( self, output ):
+        """
+        Set the header's "closed" flag and release the file and mmap in <output>.  Called at
+        the end of Writer(), or by Close() if the writer thread is no longer running.
+        """
+        mm, file = output.mm, output.file
+        output.mm = output.file = None
+        if mm != None:
+            mm[ 8:12 ] = struct.pack( '<L', 1 )
+            mm.flush()
+            mm.close()
+        if file != None: file.close()
+
+    def Writer( self, queue, output, filename, mode, run, fs, lookback ):
+        """
+        The target of the background thread started by Open().
+        """
+        recordSize = capacity = 0
+        nChannels = nSamples = nRecords = 0
+        file = output.file = open( MakeWayFor( filename ), 'w+b' )
+        file.write( struct.pack( self.headerFormat, self.magic, 0, 0, 0, 0, fs, lookback, mode, run ).ljust( self.headerSize, '\0' ) )
+        file.flush()
+        mm = output.mm = mmap.mmap( file.fileno(), self.headerSize )
+        try:
+            while True:
+                item = queue.get()
+                if item is None: break
+                signal, record = item
+                if not recordSize:
+                    nChannels, nSamples = signal.shape
+                    recordSize = 8 * ( len( self.metrics ) + signal.size )
+                    mm[ :self.headerSize ] = struct.pack( self.headerFormat, self.magic, 0, 0, nChannels, nSamples, fs, lookback, mode, run ).ljust( self.headerSize, '\0' )
+                if signal.shape != ( nChannels, nSamples ): self.dropped += 1; continue
+                if nRecords == capacity:
+                    capacity = max( capacity * 2, 64 )
+                    mm.resize( self.headerSize + capacity * recordSize )
+                offset = self.headerSize + nRecords * recordSize
+                mm[ offset : offset + recordSize ] = numpy.concatenate( ( numpy.asarray( record, dtype=numpy.float64 ), signal.ravel() ) ).tostring()
+                nRecords += 1
+                mm[ 12:16 ] = struct.pack( '<L', nRecords )
+                self.written = nRecords
+        finally:
+            self.Seal( output )
+
+    @classmethod
+    def Read( cls, filename ):
+        """
+        Read the journal at <filename>, returning None if there is no valid journal there, or
+        a Bunch with fields: closed, mode, run, fs, lookback, signals (an nTrials x nChannels
+        x nSamples numpy array) and one numpy array per name in cls.metrics.
+        """
+        if not os.path.isfile( filename ): return None
+        file = open( filename, 'rb' )
+        try:
+            header = file.read( cls.headerSize )
+            if len( header ) < cls.headerSize or not header.startswith( cls.magic ): return None
+            magic, closed, nRecords, nChannels, nSamples, fs, lookback, mode, run = struct.unpack( cls.headerFormat, header[ :struct.calcsize( cls.headerFormat ) ] )
+            recordLength = len( cls.metrics ) + nChannels * nSamples
+            records = numpy.fromfile( file, dtype=numpy.float64, count=nRecords * recordLength )
+        finally:
+            file.close()
+        nRecords = records.size // recordLength
+        records = records[ :nRecords * recordLength ].reshape( nRecords, recordLength )
+        result = Bunch( closed=bool( closed ), mode=mode.strip( '\0' ), run=run.strip( '\0' ), fs=fs, lookback=lookback )
+        for index, name in enumerate( cls.metrics ): result[ name ] = records[ :, index ]
+        result.signals = records[ :, len( cls.metrics ): ].reshape( nRecords, nChannels, nSamples )
+        return result
+
 class Operator( object ):
     """
     One Operator instance coordinates communication between one GUI instance and BCI2000's binaries.  It loads, updates and saves default
@@ -182,10 +835,16 @@ class Operator( object ):
         self.sessionStamp = None
         self.needSetConfig = True
         self.started = False
+        self.running = threading.Event() # mirrors self.started, so that GUI.WatchMM() can sleep until a run begins
 
         self.mmfilename = 'epocs.mmap'
         self.mmfile = None
         self.mm = None
+        self.mmlayout = None
+        self.mmattempts = 4      # maximum number of times ReadMM() will try to get a consistent copy of one SampleBlock
+        self.mmcounter = 0       # SampleBlock counter value of the block most recently returned by ReadMM()
+        self.mmretries = 0       # number of times during the current run that ReadMM() has had to read again because the block changed underneath it
+        self.mmtorn = 0          # number of blocks during the current run that still changed underneath ReadMM() on its final attempt
 
         dataDir = '../../data'
 
@@ -263,6 +922,11 @@ class Operator( object ):
             _RCvisibility = 'on',
             _STBackgroundEnable='no',
 
+            _BlockQueueDepth = 256, # maximum number of decoded SampleBlocks that may wait between the shared-memory thread and the Tk thread
+            _WatcherPriority = 'latency', # 'latency' or 'cpu': how GUI.WatchMM() trades off promptness against processor load while waiting for each SampleBlock
+            _TickIntervalMsec = 10, # GUI.HandlePendingTasks() aims to start this often...
+            _TickBudgetMsec = 20,   # ...and to spend at most this long per call (block processing and feedback excepted) on analysis displays and other deferred work
+
             #Automation Paramters
             _RCendpoint='Mmax',
             _aDelta= 0.5,
@@ -439,6 +1103,12 @@ class Operator( object ):
         d = os.path.split( s )[ 0 ]
         return ResolveDirectory( d, BCI2000LAUNCHDIR )
 
+    def JournalFile( self ):
+        """
+        Return the absolute path to the TrialJournal file for the current subject and session.
+        """
+        return os.path.join( self.DataDirectory(), '%s-%s-journal.bin' % ( self.params.SubjectName, self.params.SessionStamp ) )
+
     def LogFile( self, autoCreate=False ):
         """
         Return the absolute path to the log file for the current subject and session.
@@ -661,10 +1331,12 @@ class Operator( object ):
         if self.mm:
             self.mmlock.acquire()
             self.mm = None
+            self.mmlayout = None # drop the numpy views onto the mapped memory before the file is closed
             self.mmfile.close()
             self.mmlock.release()
         self.bci2000( 'set state Running 0' )
         self.started = False
+        self.running.clear()
 
     def Start( self, mode=None ):
         """
@@ -684,10 +1356,13 @@ class Operator( object ):
             self.mmfilesize = os.path.getsize( fullpath ) # TODO: do we need this?
             self.mm = mmap.mmap( self.mmfile.fileno(), self.mmfilesize, access=mmap.ACCESS_WRITE )
             self.mm.seek( 0 )    # simple test of validity
+            self.mmlayout = None # will be decoded from the header when the first SampleBlock of the run is read
+            self.mmcounter = self.mmretries = self.mmtorn = 0
             self.mmlock = threading.Lock()
 
         self.bci2000( 'set state Running 1' )
         self.started = True
+        self.running.set()
 
     def ReadMM( self ):
         """
@@ -698,14 +1373,14 @@ class Operator( object ):
         read/decoded here, and de-initialized in Stop().  ReadMM() is called by GUI.WatchMM(),
         which runs in its own thread (hence the use of self.mmlock, a threading.Lock instance).
 
-        ReadMM() returns a list of lists of floating-point signal values, and a dict of
-        floating-point State variable values. Together, these comprise one SampleBlock's worth
-        of information from BCI2000.  They are unpacked from shared memory according to
+        ReadMM() returns a channels-by-samples numpy array of floating-point signal values, and
+        a StateVector of floating-point State variable values. Together, these comprise one SampleBlock's
+        worth of information from BCI2000.  They are unpacked from shared memory according to
         the protocol established in SharedMemoryOutputConnector::Process(), as follows:
             1. Four unsigned 32-bit integers:
                 a. SampleBlock counter
-                b. number of channels (will determine the length of the outer list)
-                c. number of samples per block (will determine the length of each inner list)
+                b. number of channels (will determine the number of rows of the signal array)
+                c. number of samples per block (will determine the number of columns)
                 d. number of State variables (will determine the number of dict entries)
             2. Signal values as a packed array of double-precision floating-point numbers
                in row- (i.e. sample-)first order.
@@ -714,18 +1389,44 @@ class Operator( object ):
                names in order, followed by a newline, followed by a null terminator.
         Since this protocol is for transmission between processes on the *same* CPU, native
         endianness is assumed throughout.
+
+        The sizes in the header do not change during a run, so the offsets and the State
+        variable names are decoded only once per run, into a SharedMemoryLayout instance
+        (self.mmlayout) that holds numpy views directly onto the mapped memory, and a
+        StateIndex. Each call then only has to scale the signal view from microvolts into
+        a new array, and copy out the State values.
+
+        self.mmlock only protects against Stop() being called from the Tk thread: nothing
+        stops BCI2000 from writing the next SampleBlock while we are copying this one. So
+        the counter is read before and after copying, in the manner of a sequence lock: if
+        it has changed, the copy may be a mixture of two blocks, and it is made again (up
+        to self.mmattempts times in all).  self.mmretries counts the repeated copies made
+        during the current run, and self.mmtorn counts the blocks that were still changing
+        on the final attempt (these are returned anyway). The counter of the returned block
+        is stored in self.mmcounter.  NB: SharedMemoryOutputConnector::Write() increments the
+        counter only after it has written the block, so this check catches copies that
+        straddle the end of a write, which is the only place GUI.WatchMM() can collide with
+        the writer unless the Tk thread holds up a read for a whole SampleBlock period.
         """
-        def chomp( mm, fmt ): return struct.unpack( fmt, mm.read( struct.calcsize( fmt ) ) )
         if not self.started or not self.mm: return None, None
         self.mmlock.acquire()
-        self.mm.seek( 0 )
-        counter, nChannels, nElements, nStates = chomp( self.mm, '@LLLL' )
-        signal = [ [ x / 1e6 for x in chomp( self.mm, '@' + str( nElements ) + 'd' ) ] for channel in range( nChannels ) ]
-        statevals = chomp( self.mm, '@' + str( nStates ) + 'd' )
-        statestrings = self.mm.readline().strip().split( ' ' )
-        states = dict( zip( statestrings, statevals ) )
-        self.mmlock.release()
-        return signal, states
+        try:
+            if not self.mm: return None, None
+            layout = self.mmlayout
+            if layout == None: layout = self.mmlayout = SharedMemoryLayout( self.mm )
+            for attempt in range( self.mmattempts ):
+                before = self.MMCounter()
+                signal = layout.signal / 1e6
+                statevals = layout.states.copy()
+                after = self.MMCounter()
+                if before == after: break
+                self.mmretries += 1
+            else:
+                self.mmtorn += 1
+            self.mmcounter = after
+        finally:
+            self.mmlock.release()
+        return signal, StateVector( layout.stateIndex, statevals )
 
     def MMCounter( self ):
         """
@@ -797,9 +1498,22 @@ class GUI( tksuperclass, TkMPL ):
             disabledForeground=self.colors.disabled,
         )
         self.title( title )
-        self.pendingTasks = {}
-        self.pendingFigures = []
-        self.pendingFiguresKey = []
+        self.pendingBlocks = BlockQueue()
+        self.watcherStatistics = WatcherStatistics()
+        self.latency = LatencyProfile()
+        self.bus = MessageBus( errorCallback=self.SubscriberFailed )
+        self.bus.Subscribe( 'trial', 'store',      self.StoreTrial,       priority=0, synchronous=True )
+        self.bus.Subscribe( 'trial', 'journal',    self.JournalTrial,     priority=0, synchronous=True ) # after 'store', before 'automation' (which may stop the run and close the journal)
+        self.bus.Subscribe( 'trial', 'automation', self.AutomateTrial,    priority=1, synchronous=True )
+        self.bus.Subscribe( 'block', 'feedback',   self.UpdateFeedback,   priority=0, depth=1 )
+        self.bus.Subscribe( 'trial', 'traces',     self.PlotTrial,        priority=1, depth=1 )
+        self.bus.Subscribe( 'trial', 'mwave',      self.UpdateMwavePanel, priority=2, depth=1, minInterval=0.25 )
+        self.feedbackShown = Bunch()
+        self.journal = TrialJournal()
+        self.redraws = RedrawScheduler( frameCallback=self.latency.AddFrame ) # figures not configured otherwise (e.g. those of the M-wave analysis window) are redrawn at most 5 times per second
+        self.feedbackPriority = 1 # bus subscribers and figures with priority numbers up to this are served on every call of HandlePendingTasks(), regardless of its time budget
+        self.blockDetected = None # while a SampleBlock is being processed, the time at which WatchMM() detected it: messages published on self.bus carry it
+        self.decimators = {}
         self.afterIDs = {}
         self.messages = Bunch()
         self.states = Bunch( st=Bunch(), vc=Bunch(), rc=Bunch(), ct=Bunch(), tt=Bunch() )
@@ -815,7 +1529,6 @@ class GUI( tksuperclass, TkMPL ):
         self.SignalAvg = []
         self.MwaveMagMean = 0
         self.HwaveMagMean = 0
-        self.MwaveFigureFlag = 0
         self.channel = 0
         self.nTrials = 0
         ###
@@ -953,9 +1666,15 @@ class GUI( tksuperclass, TkMPL ):
         frame.pack( side='top', padx=2, pady=2, fill='both', expand=1 )
 
         # Finish up
+        for mode in [ 'st', 'vc', 'rc', 'ct', 'tt' ]:
+            fig = self.artists[ mode + '_figure_emg' ]
+            keys, things = self.Match( self.artists, mode )
+            animated = [ thing for key, thing in zip( keys, things ) if key.split( '_' )[ 1 ] in [ 'bar', 'target', 'text', 'line' ] and getattr( thing, 'figure', None ) is fig ]
+            self.redraws.Configure( fig, name=mode, priority=0, minInterval=1.0 / 30.0, blitter=Blitter( fig, animated ) )
         self.SetBarLimits('st', 'vc', 'rc', 'ct', 'tt' )
         self.SetTargets( 'st', 'vc', 'rc', 'ct', 'tt' )
         self.DrawFigures()
+        self.RecoverJournal()
         #self.resizable( True, False ) # STEP 13 from http://sebsauvage.net/python/gui/
         self.update(); self.geometry( self.geometry().split( '+', 1 )[ 0 ] + '+25+25' ) # prevents Tkinter from resizing the GUI when component parts try to change size (STEP 18 from http://sebsauvage.net/python/gui/ )
         self.wm_state( 'zoomed' ) # maximize the window
@@ -1076,6 +1795,12 @@ class GUI( tksuperclass, TkMPL ):
                 return
 
         self.run = 'R%02d' % self.operator.NextRunNumber() # must query this *before* starting the run
+        self.pendingBlocks.Reset( depth=self.operator.params._BlockQueueDepth )
+        self.bus.Reset()
+        self.feedbackShown.clear()
+        self.watcherStatistics.Reset( mode=self.operator.params._WatcherPriority )
+        self.latency.Reset()
+        self.redraws.Drawn() # discard anything left over from the previous run
         self.operator.Start( mode.upper() )
         self.EnableTab( mode )
         EnableWidget( self.MatchWidgets( mode, 'button' ), False )
@@ -1098,9 +1823,11 @@ class GUI( tksuperclass, TkMPL ):
         for w in self.MatchWidgets( mode, 'label', 'value', 'run' ): w.config( text=self.run )
 
         self.states[ mode ] = Bunch()
-        self.data[ mode ] = []
-        self.SignalAvg = []
+        if mode in [ 'vc' ]: self.data[ mode ] = ScalarStore()
+        else: self.data[ mode ] = TrialStore()
+        self.SignalAvg = []; self.HwaveMag = []; self.MwaveMag = []; self.BGmag = []
         self.GetSignalParameters()
+        if mode not in [ 'vc' ]: self.journal.Open( self.operator.JournalFile(), mode=mode, run=self.run, fs=self.fs, lookback=self.lookback )
         self.block = {}
         self.NewTrial( [ [ 0 ], [ 0 ], [ 0 ], [ 0 ] ], store=False )
         self.SetBarLimits( mode )
@@ -1143,6 +1870,12 @@ class GUI( tksuperclass, TkMPL ):
         msg = ''
         if self.mode not in [ 'vc' ]: msg = ' after %d trials' % len( self.data[ self.mode ] )
         self.Log( 'Stopped run %s%s' % ( self.run, msg ) )
+        if self.pendingBlocks.dropped: self.Log( 'WARNING: %s' % self.pendingBlocks.Summary() )
+        self.journal.Close()
+        if self.journal.dropped: self.Log( 'WARNING: %d trial(s) could not be written to the crash-recovery journal' % self.journal.dropped )
+        if self.operator.mmretries or self.operator.mmtorn: self.Log( 'WARNING: shared memory changed during %d SampleBlock read(s), which were repeated; %d SampleBlock(s) could not be read consistently' % ( self.operator.mmretries, self.operator.mmtorn ) )
+        self.Log( self.watcherStatistics.Summary() )
+        self.Log( self.latency.Summary() )
         self.mode = None
         self.run = None
         self.MwaveMagMean = 0; self.HwaveMagMean = 0; self.MwaveMag = []; self.HwaveMag = []; self.SignalAvg = []
@@ -1173,7 +1906,6 @@ class GUI( tksuperclass, TkMPL ):
         self.SignalAvg = []
         self.MwaveMagMean = 0
         self.HwaveMagMean = 0
-        self.MwaveFigureFlag = 0
         self.channel = 0
         self.nTrials = 0
 
@@ -1197,18 +1929,12 @@ class GUI( tksuperclass, TkMPL ):
         else:
             if trialCounterMwave != None: trialCounterMwave.configure(text='0')  ###AMIR Decrease it if it exists
 
-        self.MwaveFigureFlag = 1
-        self.NewTrial([0], store=False)
-
-        self.MwaveFigureFlag = 2
-        self.NewTrial([0,0,0], store=False)
+        self.PlotSignalAverage([0])
+        self.PlotMwaveSequence(0, 0, 0)
 
         ###AMIR Don't know a better way but if previous data was opened in M-wave analysis window, I need to re-plot it
         if len(self.MwaveLoadedData):
-            self.MwaveFigureFlag = 3
-            self.NewTrial([0], store=False)
-
-        self.MwaveFigureFlag = 0
+            self.PlotLoadedData(self.MwaveLoadedData)
 
     def SetBarLimits( self, *modes ):
         """
@@ -1376,6 +2102,7 @@ class GUI( tksuperclass, TkMPL ):
     def LoadDemoData( self, code ):
         import pickle
         self.data[ code ] = pickle.load( open( 'ExampleData.pk', 'rb' ) )[ code ]
+        if code not in [ 'vc' ]: self.data[ code ] = TrialStore( self.data[ code ] )
         EnableWidget( self.MatchWidgets( code, 'button', 'analysis' ), len( self.data[ code ] ) > 0 )
 
     def MWaveAnalysisFunc(self, code):
@@ -1476,12 +2203,42 @@ class GUI( tksuperclass, TkMPL ):
         text = self.artists[ prefix + '_text_' + suffix ] = axes.text( 0.5, 0.98, '', transform=axes.transAxes, horizontalalignment='center', verticalalignment='top' )
         return figure, widget, widget.master, axes, bar
 
-    def NeedsUpdate( self, fig ):
+    def NeedsUpdate( self, fig, key='base' ):
+        """
+        Flag the specified matplotlib.pyplot.figure instance <fig> as needing to be re-drawn
+        (see RedrawScheduler.Flag() for the meaning of <key>).
+        """
+        self.redraws.Flag( fig, key=key, origin=self.FlagOrigin() )
+
+    def NeedsBlit( self, artist ):
+        """
+        Flag the specified matplotlib <artist> as needing to be re-drawn. If it belongs to one
+        of the figures on the main tabs (those configured with a Blitter in self.redraws), only
+        the affected axes will be re-drawn, by blitting: then return True.  Otherwise, return False
+        (in which case the caller should fall back on NeedsUpdate()).
+        """
+        blitter = self.redraws.Settings( artist.figure ).blitter
+        if blitter == None or not blitter.MarkDirty( artist ): return False
+        self.redraws.Flag( artist.figure, blit=True, origin=self.FlagOrigin() )
+        return True
+
+    def FlagOrigin( self ):
         """
-        Flag the specified matplotlib.pyplot.figure instance <fig> as needing to be re-drawn.
+        Return the detection time of the SampleBlock behind the self.bus message that is
+        currently being delivered, if any, so that the redraw it leads to can be timed
+        (see LatencyProfile).
         """
-        if (fig not in self.pendingFigures) or (hasattr(self,'mwaveGUI')): ###AMIR Had to edit this as we have 2 lines in each figure of the M-wave analysis window, so update fig called twice
-            self.pendingFigures.append( fig )
+        if self.bus.current == None: return None
+        return self.bus.current.get( 'detected', None )
+
+    def Decimator( self, line ):
+        """
+        Return the DecimatedLine instance that manages the data of the specified matplotlib
+        <line>, creating it if necessary.
+        """
+        decimator = self.decimators.get( line, None )
+        if decimator == None: decimator = self.decimators[ line ] = DecimatedLine( line )
+        return decimator
 
     def UpdateTarget( self, min, max, *terms ):
         """
@@ -1492,7 +2249,7 @@ class GUI( tksuperclass, TkMPL ):
             if min == None: min = 0.0
             if max == None: max = target.axes.get_ylim()[ 1 ]
             target.set( y=min, height=max - min )
-            self.NeedsUpdate( target.figure )
+            if not self.NeedsBlit( target ): self.NeedsUpdate( target.figure )
 
     def UpdateBar( self, height, good, *terms ):
         """
@@ -1518,7 +2275,8 @@ class GUI( tksuperclass, TkMPL ):
             val = FormatWithUnits( value=height, context=ylim, units=controller.units, appendUnits=True )
             text.set_text( val )
         elif text.get_text() != '': text.set_text( '' )
-        self.NeedsUpdate( bar.figure )
+        if not self.NeedsBlit( bar ): self.NeedsUpdate( bar.figure )
+        self.NeedsBlit( text )
 
     def After( self, msec, key, func ):
         """
@@ -1589,48 +2347,57 @@ class GUI( tksuperclass, TkMPL ):
         else: stamp = ''
         self.widgets.log_scrolledtext.append( stamp + text + '\n', ensure_newline_first=True )
 
-    def ScheduleTask( self, key, func ):
-        """
-        Add a callable <func> to the set of tasks that should be performed during
-        the regular calls to HandlePendingTasks().
-        """
-        self.pendingTasks[ key ] = func
-
     def HandlePendingTasks( self ):
         """
-        Call, and remove from the pending list, any tasks registered with ScheduleTask().
-        Note that functions are not called in any defined order.
-        Also, re-draw any figures that have been flagged with NeedsUpdate().
-        Finally, re-schedule the next call of HandlePendingTasks after a fixed short
-        interval, using After().  The initial registration happens in Loop(), which is
-        called in the __main__ part of the file.
+        A cooperative scheduler for the work of the Tk thread, in three stages:
+
+        1. Ingestion: process every SampleBlock that WatchMM() has queued in
+           self.pendingBlocks since the last call, in the order in which they arrived.
+        2. Feedback: deliver the resulting messages to the self.bus subscribers whose
+           priority number is no higher than self.feedbackPriority, then re-draw (or blit)
+           the flagged figures of the same priority (see NeedsUpdate(), NeedsBlit() and
+           RedrawScheduler).  The first two stages always run to completion.
+        3. Deferred work: serve the remaining bus subscribers and re-draw the remaining
+           figures, until the operator's _TickBudgetMsec (counted from the start of the
+           call) has been used up.  Whatever is left over stays
+           queued or flagged, and is carried over to the next call.
+
+        The time at which each block reaches each of these stages is recorded in
+        self.latency (see LatencyProfile).  Finally, re-schedule the next call using
+        After(), so that it starts _TickIntervalMsec after the start of this one (or as
+        soon as possible, if this one took longer, or if work was carried over).  The
+        initial registration happens in Loop(), which is called in the __main__ part of
+        the file.
         """
-        for v in self.pendingTasks.values(): v()
-        self.pendingTasks.clear()
+        clock = timeit.default_timer
+        start = clock()
+        deadline = start + self.operator.params._TickBudgetMsec / 1000.0
 
-        ###AMIR changed this, as I am plotting on top of the Mwave figure so need to have it in the list twice
-        ### 	working on the assumption that the 2nd addition to pendingFigures of the same line will be right after the first call
-
-        while len( self.pendingFigures ):
-
-            #while fig in self.pendingFigures: self.pendingFigures.remove( fig )
-            fig = self.pendingFigures.pop( 0 )
-
-            if self.pendingFiguresKey:	key = self.pendingFiguresKey.pop( 0 ) ###This just let's me know if it is a normal plot, signal average or the sequence
-            else: key = 'base'
-
-            if key == 'base':
-                fig.canvas.draw() ###AMIR Repeat flag tells me the same figure is called twice (which is the case for plotting Signal Average and the Signal)
-            elif key == 'SignalAvg':
-                fig.hold(True)
-                fig.canvas.draw()
-                fig.hold(False)
-            elif key == 'Sequence':
-                fig.hold(True)
-                fig.canvas.draw()
-            else: fig.canvas.draw()
-
-        self.After( 10, 'HandlePendingTasks', self.HandlePendingTasks )
+        try:
+            blocks = self.pendingBlocks.GetAll()
+            dequeued = clock()
+            for states, signal, ( detected, decoded ) in blocks:
+                self.blockDetected = detected
+                self.ProcessStatesAndSignal( states=states, signal=signal )
+                self.latency.Add( detected, decode=decoded, dequeue=dequeued, incoming=clock() )
+            self.blockDetected = None
+            overflows = self.pendingBlocks.Overflows()
+            if overflows and self.mode != None: self.Log( 'WARNING: shared-memory block queue overflowed: %d SampleBlock(s) discarded' % overflows )
+
+            self.bus.Deliver( maxPriority=self.feedbackPriority )
+            self.redraws.Draw( maxPriority=self.feedbackPriority )
+
+            self.bus.Deliver( deadline=deadline )
+            remaining = deadline - clock()
+            if remaining > 0.0: self.redraws.Draw( budget=remaining )
+
+            # a block whose messages flagged a figure gets a 'draw' sample when the first such figure has been drawn (which may be in a later call, if the figure's redraw rate is capped)
+            for detected, finished in self.redraws.Drawn(): self.latency.Add( detected, draw=finished )
+        finally: # whatever happens, keep the tick loop (and with it the live feedback) going
+            carriedOver = clock() >= deadline and ( self.bus.Queued() or self.redraws.Pending() )
+            if carriedOver: delay = 1
+            else: delay = max( 1, int( round( self.operator.params._TickIntervalMsec - 1000.0 * ( clock() - start ) ) ) )
+            self.After( delay, 'HandlePendingTasks', self.HandlePendingTasks )
 
         if self.StopFlag:
             self.Stop(mode=self.mode)
@@ -1638,23 +2405,73 @@ class GUI( tksuperclass, TkMPL ):
 
     def WatchMM( self ):
         """
-        Check at 1-millisecond intervals until the Operator's shared memory area reports
-        that a new SampleBlock has been made available by BCI2000. When a new block arrives,
-        read it, decode it, and schedule it for processing.
+        Wait until the Operator's shared memory area reports that a new SampleBlock has been
+        made available by BCI2000. When a new block arrives, read it, decode it, and append
+        it to the self.pendingBlocks queue for processing, together with the times at which
+        the change of counter was detected and at which the block had been decoded (for
+        the benefit of self.latency).
+
+        While no run is in progress, the thread parks on the Operator's self.running event.
+        During a run, blocks arrive every SampleBlockSize / SamplingRate seconds, so after
+        each block the thread sleeps until shortly before the next one is due, then polls
+        the counter until it changes.  How it does so depends on the _WatcherPriority setting:
+            'latency': wake up early by an adaptive margin (widened whenever the block turns
+                       out to have arrived already, narrowed otherwise) and spin-poll, yielding
+                       the processor between polls but never sleeping;
+            'cpu':     wake up when the block is due and poll at 1-millisecond intervals.
+        The resulting wake-to-block lag is accumulated in self.watcherStatistics, and reported
+        in the log when the run stops.  Until the first block of a run has arrived (or if
+        blocks stop arriving on schedule) the counter is simply polled at 1-millisecond
+        intervals.
 
         NB: this is run in a thread, and TkInter is not thread-safe. So we cannot touch
-        any Tk widgets from this code. We use ScheduleTask instead - HandlePendingTasks
-        mops these up every 10ms.
+        any Tk widgets from this code. Instead, HandlePendingTasks mops up the queued
+        blocks every 10ms.  Blocks in which TrialsCompleted changes are marked as
+        important, so that they are the last to be sacrificed if the queue ever fills up.
         """
+        def new( counter ): return counter != prev and counter != 0
+        now = timeit.default_timer # high-resolution clock on all platforms
         counter = prev = 0
+        trials = None
+        lastArrival = None
+        margin = 0.002
         while self.keepgoing:
-            while self.keepgoing and ( counter == prev or counter == 0 ):
-                time.sleep( 0.001 )
+            if not self.operator.started:
+                lastArrival = None
+                self.operator.running.wait( 0.5 )
+                continue
+            latencyFirst = ( self.watcherStatistics.mode != 'cpu' )
+            period = getattr( self, 'sbs', 0 ) / getattr( self, 'fs', 1.0 )
+            if lastArrival != None and period > 0:
+                due = lastArrival + period
+                if latencyFirst: due -= margin
+                delay = due - now()
+                if delay > 0: time.sleep( delay )
+                woke = now()
                 counter = self.operator.MMCounter()
-            if self.keepgoing:
+                late = new( counter )
+                while self.keepgoing and self.operator.started and not new( counter ):
+                    if latencyFirst and now() - woke < period: time.sleep( 0 )
+                    else: time.sleep( 0.001 )
+                    counter = self.operator.MMCounter()
+                lastArrival = now()
+                self.watcherStatistics.Add( lag=lastArrival - woke, late=late )
+                if late: margin = min( margin * 2.0, period / 2.0 )
+                else: margin = max( margin * 0.95, 0.0005 )
+            else:
+                while self.keepgoing and self.operator.started and not new( counter ):
+                    time.sleep( 0.001 )
+                    counter = self.operator.MMCounter()
+                lastArrival = now()
+            if self.keepgoing and new( counter ):
                 prev = counter
                 signal, states = self.operator.ReadMM()
-                self.ScheduleTask( 'update_states_and_signal', Curry( self.ProcessStatesAndSignal, states=states, signal=signal ) )
+                decoded = now()
+                if states is None: continue
+                prev = self.operator.mmcounter # may be later than <counter> if ReadMM() had to read again
+                newTrials = states.get( 'TrialsCompleted', None )
+                self.pendingBlocks.Put( ( states, signal, ( lastArrival, decoded ) ), important=( newTrials != trials ) )
+                trials = newTrials
 
     def ProcessStatesAndSignal( self, states, signal ):
         """
@@ -1675,8 +2492,12 @@ class GUI( tksuperclass, TkMPL ):
         TrialsCompleted indicates that a new trial has arrived, or False otherwise.
         This code also updates the visible trial counter and success-rate counter.
 
-        The 'Signal' queue assumes that the signal belongs to a new trial and passes
-        it straight on to NewTrial().
+        The 'Signal' queue assumes that the signal belongs to a new trial and publishes
+        it, once, on the 'trial' topic of self.bus, together with a snapshot of the State
+        variables. Consumers of the 'trial' topic (StoreTrial(), AutomateTrial(), PlotTrial()
+        and UpdateMwavePanel()) take it from there.  Similarly, after the State variables of
+        each block have been processed they are published on the 'block' topic, for the
+        feedback bars (UpdateFeedback()).
 
         Sorry about this slightly convoluted way of doing things: the architecture was
         designed during the transition/performance-debugging period between UDP
@@ -1685,108 +2506,36 @@ class GUI( tksuperclass, TkMPL ):
         """
         code = self.mode
         if code == None: return False
-        states = self.states[ code ]
 
-        if block == None: return False
+        if block is None: return False
         UD = getattr(self.operator.params, '_UpDownTrialCount', None)
         if UD == None: UD = 'up'
 
-        ProcessCompleted = False
-
         if queue == 'Signal':
             #As signal follows state then we can assume a change (i.e. TrialsCompleted Changed)...
-            self.NewTrial( block )
-            self.AnalyzeValues(block, states)  ###AMIR New function to extract H and W Signal Features
-
-            if hasattr(self, 'stimGUI') and self.stimGUI.Automate.get() and AUTOMATION:
-                if (code in 'st'):
-                    ProcessCompleted = self.ControlObject.STProcess()
-                if (code in 'rc'):
-                    ProcessCompleted = self.ControlObject.RCProcess()
-
-            if hasattr(self,'mwaveGUI'): ###AMIR only run this if the GUI exists
-
-                ###AMIR Update M-wave Panel mean and current value: TODO, MOVE ALL THESE INTO THEIR OWN SET OF FUNCTIONS
-                self.panel.MeanM.set(self.MwaveMagMean)
-                if int(len(self.MwaveMag)-2 > 0): self.panel.LastM.set(self.MwaveMag[int(len(self.MwaveMag)-2)])
-                self.panel.CurrentM.set(self.MwaveMag[int(len(self.MwaveMag)-1)])
-                self.panel.CurrentH.set(self.HwaveMag[int(len(self.HwaveMag)-1)])
-                self.panel.CurrentH.set(max(self.HwaveMag))
-                #Update Current on M-wave axes
-                # if DIGITIMER and hasattr(self,'stimGUI'):
-                #
-                #     indx = len(self.stimGUI.CurrentAmplitudeState[self.mode])-1
-                #     Current = self.stimGUI.CurrentAmplitudeState[self.mode][indx]
-                #     xlabels = [xlabel.get_text() for xlabel in self.mwaveGUI.axes_seq.get_xticklabels()]
-                #
-                #     if Current > 50: xlabels[indx]= '{:.2f}'.format(Current/1000)
-                #     else: xlabels[indx]= '{:.2f}'.format(Current)
-                #
-                #     self.mwaveGUI.axes_seq.get_xticklabels()[indx].set_rotation(45)
-                #     self.mwaveGUI.axes_seq.set_xticklabels(xlabels)
-                #     self.mwaveGUI.axes_seq.figure.canvas.draw()
-
-                #AMIR Plot the Average on top of the current relevant axes
-                self.MwaveFigureFlag = 1
-                self.NewTrial(self.SignalAvg,store=False)
-
-                #Sequence Plot on Mwave Analysis Window
-                self.MwaveFigureFlag = 2
-                self.NewTrial([range(1,int(states.TrialsCompleted)+1), self.MwaveMag, self.HwaveMag], store=False)
-                if int(self.mwaveGUI.axes_seq.get_xlim()[1]-0.5) < int(states.TrialsCompleted):
-                    self.mwaveGUI.axes_seq.set_xlim([0, int(states.TrialsCompleted) + 0.5])
-                    Xticks = range(0, int(states.TrialsCompleted) + 1)
-                    self.mwaveGUI.axes_seq.set_xticks(Xticks)
-                    self.mwaveGUI.artists.axes_emg_seq_mwave.grid(True)
-
-                ###AMIR Don't know a better way but if previous data was opened in M-wave analysis window, I need to re-plot it
-                if len(self.MwaveLoadedData):
-                    self.MwaveFigureFlag = 3
-                    self.NewTrial(self.MwaveLoadedData, store=False)
-
-                self.MwaveFigureFlag = 0
-
-            if code in ['ct','tt'] and UD=='down':
-                if (int(self.nTrials) == 0):
-                    self.StopFlag = True
-
-            if ProcessCompleted:
-                self.Stop(mode=code)
-                self.ControlObject.ProcessCompletion()
-
-            return False
-
-        if len( states ) == 0:
-            states.update( block )
+            self.bus.Publish( 'trial', mode=code, signal=block, states=self.states[ code ], detected=self.blockDetected )
             return False
 
-        newTrial = False
-        changed = Bunch( ( k, False ) for k in states )
-        for key, value in block.items():
-            changed[ key ] = ( states.get( key, None ) != value )
-            states[ key ] = value
+        # each block's StateVector is read-only, so it can simply replace the previous one, and be published as it is
+        previous = self.states[ code ]
+        self.states[ code ] = states = block
+        self.bus.Publish( 'block', mode=code, states=states, detected=self.blockDetected )
+        if len( previous ) == 0: return False
 
-        if self.mode in [ 'vc' ]: self.data[ self.mode ].append( states.BackgroundFeedbackValue / 1000000.0 )
+        k = states.Index()
+        values = states.Values()
+        changed = states.Changed( previous )
 
-        if self.mode in ['st'] and self.operator.params._STBackgroundEnable=='no':
-            self.UpdateBar(0, 0, code, 'background')
-        else:
-            if changed.BackgroundFeedbackValue or changed.BackgroundGreen:
-                height = states.BackgroundFeedbackValue / 1000000.0
-                good = ( states.BackgroundGreen != 0.0 )
-                self.UpdateBar( height, good, code, 'background' )
+        newTrial = False
 
-        if changed.ResponseFeedbackValue or changed.ResponseGreen:
-            height = states.ResponseFeedbackValue / 1000000.0
-            good = ( states.ResponseGreen != 0.0 )
-            self.UpdateBar( height, good, code, 'response' )
+        if self.mode in [ 'vc' ]: self.data[ self.mode ].append( values[ k.BackgroundFeedbackValue ] / 1000000.0 )
 
         #if changed.EnableTrigger and hasattr(self, 'stimGUI'):
         #	self.stimGUI.GetCurrent(mode=code)
 
             #Set the new current the user sees when EnableTrigger is set. We then know what the person was just stimulated with
 
-        if changed.TrialsCompleted: # the TrapFilter.cpp filter inside the ReflexConditioningSignalProcessing.exe module increments the TrialsCompleted state variable to indicate that a new trial has been trapped
+        if changed[ k.TrialsCompleted ]: # the TrapFilter.cpp filter inside the ReflexConditioningSignalProcessing.exe module increments the TrialsCompleted state variable to indicate that a new trial has been trapped
 
             trialCounter = self.widgets.get( code + '_label_value_trial', None )
             successCounter = self.widgets.get( code + '_label_value_success', None )
@@ -1797,29 +2546,28 @@ class GUI( tksuperclass, TkMPL ):
             #For this version to plot the RC currents I need to add the current to the states
             #DS5 = int(self.operator.remote.GetParameter('EnableDS5ControlFilter'))
             #if DS5 == 1:
-            if hasattr(self, 'stimGUI'): self.stimGUI.CurrentAmplitudeState[ code ].append(self.states[code].CurrentAmplitude)
+            if hasattr(self, 'stimGUI'): self.stimGUI.CurrentAmplitudeState[ code ].append(values[ k.CurrentAmplitude ])
 
             if self.mode in ['ct','tt'] and UD=='down':
                 # LOAD UP THE SETTING
                 N = getattr(self.operator.params, '_' + code + 'TrialsCount')
-                self.nTrials = int(N - states.TrialsCompleted)
+                self.nTrials = int(N - values[ k.TrialsCompleted ])
                 if trialCounter != None: trialCounter.configure(text='%d' % (self.nTrials))
                 if trialCounterMwave != None: trialCounterMwave.configure(
                     text='%d' % (self.nTrials))  ###AMIR Decrease it if it exists
             else:
                 if trialCounter != None:
-                    trialCounter.configure( text='%d' % states.TrialsCompleted )
+                    trialCounter.configure( text='%d' % values[ k.TrialsCompleted ] )
                 if trialCounterMwave != None:
-                    trialCounterMwave.configure(text='%d' % states.TrialsCompleted) ###AMIR Increment it if it exists
+                    trialCounterMwave.configure(text='%d' % values[ k.TrialsCompleted ]) ###AMIR Increment it if it exists
 
 
-            if states.TrialsCompleted == 0:
-                states.SuccessfulTrials = None
+            if values[ k.TrialsCompleted ] == 0:
                 if successCounter != None: successCounter.configure( text='---', fg='#000000' )
             else:
                 newTrial = True
                 if successCounter != None:
-                    percent = 100.0 * float( states.SuccessfulTrials ) / float( states.TrialsCompleted )
+                    percent = 100.0 * float( values[ k.SuccessfulTrials ] ) / float( values[ k.TrialsCompleted ] )
                     percent = '%.1f' % percent
                     if float( percent ) == 100: percent = '100'
                     #if percent <= 50.0: color = self.colors.bad
@@ -1831,50 +2579,210 @@ class GUI( tksuperclass, TkMPL ):
 
         return newTrial
 
-    def	NewTrial( self, signal, store=True ,**kwargs ):
+    def UpdateFeedback( self, message ):
+        """
+        Consumer of the 'block' topic of self.bus: move the background and response feedback
+        bars to reflect the latest State variable values.  Only the latest block matters, so
+        blocks that arrive between two calls are never seen.  Every block is published, but a
+        bar is only updated (and its figure flagged) if its value or colour differs from what
+        self.feedbackShown says is on screen.
+        """
+        code = message.mode
+        if code != self.mode: return
+        k = message.states.Index()
+        values = message.states.Values()
+        shown = self.feedbackShown
+
+        if code in ['st'] and self.operator.params._STBackgroundEnable=='no':
+            background = ( 0, 0 )
+        else:
+            background = ( values[ k.BackgroundFeedbackValue ] / 1000000.0, values[ k.BackgroundGreen ] != 0.0 )
+        if shown.get( 'background', None ) != background:
+            self.UpdateBar( background[ 0 ], background[ 1 ], code, 'background' )
+            shown.background = background
+
+        response = ( values[ k.ResponseFeedbackValue ] / 1000000.0, values[ k.ResponseGreen ] != 0.0 )
+        if shown.get( 'response', None ) != response:
+            self.UpdateBar( response[ 0 ], response[ 1 ], code, 'response' )
+            shown.response = response
+
+    def StoreTrial( self, message ):
+        """
+        Synchronous consumer of the 'trial' topic of self.bus: store the new trial and
+        analyze it (see AnalyzeValues()), noting the stimulation amplitude and background
+        EMG magnitude alongside it in the TrialStore.  The values derived from this trial
+        are also attached to the message, as message.analysis, for later consumers: unlike
+        self.HwaveMag etc., they cannot be reset by a Stop() in the meantime.
+        """
+        code = message.mode
+        if code not in [ 'vc' ]: self.data[ code ].append( message.signal, amplitude=message.states.get( 'CurrentAmplitude', numpy.nan ), run=self.run )
+        self.AnalyzeValues( message.signal, message.states ) ###AMIR New function to extract H and W Signal Features
+        message.analysis = Bunch( HwaveMag=self.HwaveMag[ -1 ], MwaveMag=self.MwaveMag[ -1 ], BGmag=self.BGmag[ -1 ] )
+        if code not in [ 'vc' ]: self.data[ code ].background[ -1 ] = message.analysis.BGmag
+
+        UD = getattr(self.operator.params, '_UpDownTrialCount', None)
+        if code in ['ct','tt'] and UD=='down':
+            if (int(self.nTrials) == 0):
+                self.StopFlag = True
+
+    def AutomateTrial( self, message ):
+        """
+        Synchronous consumer of the 'trial' topic of self.bus: if automated current control
+        is switched on, pass each new trial to it, and stop the run when it reports that it
+        has finished.
+        """
+        code = message.mode
+        ProcessCompleted = False
+        if hasattr(self, 'stimGUI') and self.stimGUI.Automate.get() and AUTOMATION:
+            if (code in 'st'):
+                ProcessCompleted = self.ControlObject.STProcess()
+            if (code in 'rc'):
+                ProcessCompleted = self.ControlObject.RCProcess()
+
+        if ProcessCompleted:
+            self.Stop(mode=code)
+            self.ControlObject.ProcessCompletion()
+
+    def JournalTrial( self, message ):
+        """
+        Synchronous consumer of the 'trial' topic of self.bus: pass the new trial, and the
+        values that StoreTrial() has attached to the message, to self.journal (which writes
+        them to disk in the background).
+        """
+        analysis = message.get( 'analysis', Bunch() )
+        self.journal.Append( message.signal,
+            TrialsCompleted=message.states.get( 'TrialsCompleted', numpy.nan ),
+            CurrentAmplitude=message.states.get( 'CurrentAmplitude', numpy.nan ),
+            **analysis
+        )
+
+    def SubscriberFailed( self, subscription, message ):
+        """
+        The errorCallback of self.bus, called while the exception raised by one of its
+        subscribers is being handled: the traceback goes to the console, and the first
+        failure of each subscriber since the last Reset() is also logged.
+        """
+        traceback.print_exc()
+        if subscription.failed == 1: self.Log( 'WARNING: the %r consumer of %r messages failed (%s: %s)' % ( subscription.name, subscription.topic, sys.exc_info()[ 0 ].__name__, sys.exc_info()[ 1 ] ) )
+
+    def RecoverJournal( self ):
+        """
+        Called at the end of construction.  If the TrialJournal for the current session shows
+        that the last run was interrupted (i.e. the GUI crashed or was killed during the run),
+        reload its trials and analysis values, so that the run can be analyzed without
+        having to go back to the .dat file.
+        """
+        try: journal = TrialJournal.Read( self.operator.JournalFile() )
+        except: journal = None # TODO: DANGER - indiscriminate exception-catching (but a damaged journal must never prevent the GUI from starting)
+        if journal == None or journal.closed or journal.mode not in self.data or not len( journal.signals ): return
+        mode = journal.mode
+        self.data[ mode ] = TrialStore( journal.signals, amplitude=journal.CurrentAmplitude, background=journal.BGmag, run=journal.run )
+        self.HwaveMag = journal.HwaveMag.tolist()
+        self.MwaveMag = journal.MwaveMag.tolist()
+        self.BGmag = journal.BGmag.tolist()
+        self.MwaveMagMean = sum( self.MwaveMag ) / len( self.MwaveMag )
+        self.HwaveMagMean = sum( self.HwaveMag ) / len( self.HwaveMag )
+        if hasattr( self, 'stimGUI' ): self.stimGUI.CurrentAmplitudeState[ mode ] = journal.CurrentAmplitude.tolist()
+        for w in self.MatchWidgets( mode, 'label', 'title', 'run' ): w.config( text='Last Recording:' )
+        for w in self.MatchWidgets( mode, 'label', 'value', 'run' ): w.config( text=journal.run )
+        EnableWidget( self.MatchWidgets( mode, 'button', 'analysis' ), True )
+        self.Log( 'Recovered %d trials of interrupted run %s (%s) from %s' % ( len( self.data[ mode ] ), journal.run, self.modenames[ mode ], self.operator.JournalFile() ) )
+
+    def PlotTrial( self, message ):
+        """
+        Consumer of the 'trial' topic of self.bus: update the traces of the latest trial.
+        """
+        self.NewTrial( message.signal, store=False, mode=message.mode )
+
+    def UpdateMwavePanel( self, message ):
+        """
+        Consumer of the 'trial' topic of self.bus: if the M-wave analysis window is open,
+        update its panel, signal average and sequence plot.  This is served at a lower
+        priority than the feedback bars and traces, and at most four times per second.
+        """
+        if not hasattr(self,'mwaveGUI'): return ###AMIR only run this if the GUI exists
+        if not len(self.MwaveMag): return # the run has been stopped and the analysis values reset since this trial arrived
+        code = message.mode
+        states = message.states
+
+        ###AMIR Update M-wave Panel mean and current value: TODO, MOVE ALL THESE INTO THEIR OWN SET OF FUNCTIONS
+        self.panel.MeanM.set(self.MwaveMagMean)
+        if int(len(self.MwaveMag)-2 > 0): self.panel.LastM.set(self.MwaveMag[int(len(self.MwaveMag)-2)])
+        self.panel.CurrentM.set(self.MwaveMag[int(len(self.MwaveMag)-1)])
+        self.panel.CurrentH.set(self.HwaveMag[int(len(self.HwaveMag)-1)])
+        self.panel.CurrentH.set(max(self.HwaveMag))
+
+        #AMIR Plot the Average on top of the current relevant axes
+        self.PlotSignalAverage(self.SignalAvg, mode=code)
+
+        #Sequence Plot on Mwave Analysis Window
+        self.PlotMwaveSequence(range(1,len(self.MwaveMag)+1), self.MwaveMag, self.HwaveMag)
+        if int(self.mwaveGUI.axes_seq.get_xlim()[1]-0.5) < int(states.TrialsCompleted):
+            self.mwaveGUI.axes_seq.set_xlim([0, int(states.TrialsCompleted) + 0.5])
+            Xticks = range(0, int(states.TrialsCompleted) + 1)
+            self.mwaveGUI.axes_seq.set_xticks(Xticks)
+            self.mwaveGUI.artists.axes_emg_seq_mwave.grid(True)
+
+        ###AMIR Don't know a better way but if previous data was opened in M-wave analysis window, I need to re-plot it
+        if len(self.MwaveLoadedData):
+            self.PlotLoadedData(self.MwaveLoadedData)
+
+    def	NewTrial( self, signal, store=True, mode=None, **kwargs ):
         """
         Called during Incoming() operations on the 'Signal' queue, which is called during
         ProcessStatesAndSignal() if there is an increment in the TrialsCompleted state
         variable indicating that a new trial has arrived (ProcessStatesAndSignal itself is
-        called indirectly via ScheduleTask() during the WatchMM() thread).
-
-        Stores the data, and updates any graphical traces of the EMG epoch.
-        """
-        if signal == None: return
-        if store and self.mode not in [ 'vc' ]:	self.data[ self.mode ].append( signal )
-
-        if self.MwaveFigureFlag == 0: ###AMIR First part same as previous version
-            for channelIndex, values in enumerate( signal ):
-                lines = self.MatchArtists( self.mode, 'line', 'emg' + str( channelIndex + 1 ) )
-                if len( lines ) == 0: continue
-                for line in lines:
-                    line.set( xdata=TimeBase( values, self.fs, self.lookback ), ydata=values )
-                    self.NeedsUpdate( line.figure )
-                    self.pendingFiguresKey.append('base')
-        ###AMIR However, if the M-wave Analysis Window Exists then we want to process the SignalAvg which has no channel indices
-        elif self.MwaveFigureFlag == 1:
-                lines = self.MatchArtists(self.mode, 'line', 'sigavg','mwave')
-                for line in lines:
-                    line.set(xdata=TimeBase(signal, self.fs, self.lookback), ydata=signal)
-                    self.NeedsUpdate(line.figure)
-                    self.pendingFiguresKey.append('SignalAvg')
-        elif self.MwaveFigureFlag == 2:  ###AMIR We are updating the M wave sequence plot which is one value at a time...
-                    lines = self.MatchArtists('sequenceM','line', 'mwave')
-                    for line in lines:
-                        line.set(xdata=signal[0], ydata=signal[1])
-                        self.NeedsUpdate(line.figure)
-                        self.pendingFiguresKey.append('Sequence')
-                    lines = self.MatchArtists('sequenceH', 'line', 'mwave')
-                    for line in lines:
-                        line.set(xdata=signal[0], ydata=signal[2])
-                        self.NeedsUpdate(line.figure)
-                        self.pendingFiguresKey.append('Sequence')
-        else:
-            lines = self.MatchArtists('loaded','prevdata','mwave')
+        called by HandlePendingTasks() for each SampleBlock that the WatchMM() thread has
+        queued).
+
+        Stores the data, and updates any graphical traces of the EMG epoch. The <mode>
+        defaults to the current mode.
+        """
+        if signal is None: return
+        if mode == None: mode = self.mode
+        if store and mode not in [ 'vc' ]:	self.data[ mode ].append( signal, run=self.run )
+
+        for channelIndex, values in enumerate( signal ):
+            lines = self.MatchArtists( mode, 'line', 'emg' + str( channelIndex + 1 ) )
+            if len( lines ) == 0: continue
             for line in lines:
-                line.set(xdata=signal[0], ydata=signal[1])
-                self.NeedsUpdate(line.figure)
-                self.pendingFiguresKey.append('sigavg')
+                self.Decimator( line ).SetData( TimeBase( values, self.fs, self.lookback ), values ) # the line gets a decimated copy: <signal> itself is stored whole
+                if not self.NeedsBlit( line ): self.NeedsUpdate( line.figure, 'base' )
+
+    def PlotSignalAverage( self, signal, mode=None ):
+        """
+        ###AMIR Show <signal>, a single channel (the running signal average), on the signal
+        figure of the M-wave analysis window.  The <mode> defaults to the current mode.
+        """
+        if mode == None: mode = self.mode
+        lines = self.MatchArtists(mode, 'line', 'sigavg','mwave')
+        for line in lines:
+            line.set(xdata=TimeBase(signal, self.fs, self.lookback), ydata=signal)
+            self.NeedsUpdate(line.figure, 'SignalAvg')
+
+    def PlotMwaveSequence( self, trials, MwaveMag, HwaveMag ):
+        """
+        ###AMIR Show the M-wave and H-reflex magnitudes of the <trials> so far on the sequence
+        figure of the M-wave analysis window.
+        """
+        lines = self.MatchArtists('sequenceM','line', 'mwave')
+        for line in lines:
+            line.set(xdata=trials, ydata=MwaveMag)
+            self.NeedsUpdate(line.figure, 'Sequence')
+        lines = self.MatchArtists('sequenceH', 'line', 'mwave')
+        for line in lines:
+            line.set(xdata=trials, ydata=HwaveMag)
+            self.NeedsUpdate(line.figure, 'Sequence')
+
+    def PlotLoadedData( self, data ):
+        """
+        ###AMIR Show the previously recorded signal average that the M-wave analysis window
+        has loaded, given as <data> = [ times, values ] (or [ 0, 0 ] to clear it).
+        """
+        lines = self.MatchArtists('loaded','prevdata','mwave')
+        for line in lines:
+            line.set(xdata=data[0], ydata=data[1])
+            self.NeedsUpdate(line.figure, 'sigavg')
 
     def AnalyzeValues(self, signal, states):
         """
@@ -1913,7 +2821,8 @@ class GUI( tksuperclass, TkMPL ):
         with the specified positional arguments and keyword arguments.
 
         NB: TkInter is not thread-safe, so the code in <func> should not touch any Tk widgets.
-        ScheduleTask can be used instead - HandlePendingTasks mops these up every 10ms.
+        Hand results over to the Tk thread instead, as WatchMM() does via self.pendingBlocks,
+        which HandlePendingTasks empties every _TickIntervalMsec.
         """
         t = self.threads[ name ] = threading.Thread( target=func, args=pargs, kwargs=kwargs )
         t.start()
@@ -2090,27 +2999,11 @@ class STAnalysisWindow( Dialog, TkMPL):
         SubFrame.place(relx=0.5,rely=0.5,anchor='center')
         TableHeader.pack(side='left', fill='both', expand='y')
 
-    def LineSet(self,LineRef,color='#0000FF',alpha=0.3,zorder=2,linewidth=1):
-
-        LineRef.set_color(color)
-        LineRef.set_linewidth(linewidth)
-        LineRef.zorder = zorder
-        LineRef.set_alpha(alpha)
-
-
     def UpdateOverlay(self,index,newValue):
 
         self.overlay.emphasis[index] = newValue
         self.emphasis = self.overlay.emphasis
-        self.lines = self.overlay.lines
-        #self.overlay.Update()
-        #There is self.overlay options to update the lines through lineprops but this seems to be buggy for some unknown reason
-        for line, emphasis in zip(self.artists.overlay_axes_main.lines, self.emphasis ):
-            if emphasis == 1:
-                self.LineSet(LineRef=line,color='#FF00FF', alpha=0.8, zorder=3, linewidth=2)
-            else:
-                self.LineSet(LineRef=line, color='#0000FF', alpha=0.3, zorder=2, linewidth=1)
-
+        self.overlay.Update()
         self.overlay_figure.canvas.draw()
 
     def cancel(self, event=None):
@@ -2128,7 +3021,12 @@ class AnalysisWindow( Dialog, TkMPL ):
     If DEVEL is True (i.e. if this file was run with the --devel flag) then the
     AnalysisWindow instance is available as the .child attribute of the parent GUI()
     or OfflineAnalysis() instance, and the constructor will not block.
+
+    Its figures are rendered off the Tk thread (see TK.RenderServer) so that redrawing
+    them does not interrupt the feedback on the main GUI.
     """
+    offThreadRendering = True
+
     def __init__( self, parent, mode, geometry=None, modal=True, online=True ):
         """
         AnalysisWindow constructor
@@ -2171,7 +3069,8 @@ class AnalysisWindow( Dialog, TkMPL ):
                 else: self.Currents = ['{:.2f}'.format(i) for i in csorted]
                 cindx = sorted(range(len(c)), key=lambda k: c[k])
                 #Need to refine this for pooled data
-                data_sorted = [self.data[k] for k in cindx]
+                if isinstance(self.data, TrialStore): data_sorted = self.data.take(cindx)
+                else: data_sorted = [self.data[k] for k in cindx]
                 self.data = data_sorted
             else:
                 if max(c) > 50: self.Currents = ['{:.2f}'.format(i/1000) for i in c]
@@ -3481,7 +4380,9 @@ class OfflineAnalysis( object ):
         self.fs = float( unique.SamplingRate[ 0 ] )
         self.sbs = float( unique.SampleBlockSize[ 0 ] )
         self.lookback = float( unique.LookBack[ 0 ] )
-        if self.mode not in 'vc': data = reduce( list.__add__, [ obj.Epochs.Data for obj in objs ] )
+        if self.mode not in 'vc':
+            data = TrialStore()
+            for obj in objs: data.extend( obj.Epochs.Data, run=obj.ImportantParameters.SubjectRun )
         else:
             data = objs[0].States.BackgroundFeedbackValue / 1e6
             data = data.tolist()
@@ -3545,6 +4446,7 @@ class OfflineAnalysis( object ):
 
 if __name__ == '__main__':
 
+    multiprocessing.freeze_support()  # lets a py2exe/pyinstaller binary start the TK.RenderServer process
     args = getattr( sys, 'argv', [] )[ 1: ]
 
     try: import EpocsCommandLineArguments  # if present, this might say something like args = [ "--offline" ]
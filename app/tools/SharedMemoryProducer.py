@@ -0,0 +1,347 @@
+"""
+A stand-in for the BCI2000 side of the EPOCS shared-memory link, for benchmarking and
+load-testing the Python pipeline (Operator.ReadMM, GUI.WatchMM, GUI.Incoming, GUI.NewTrial...)
+without a live BCI2000 installation, and therefore also on non-Windows platforms.
+
+It writes SampleBlocks into the memory-mapped file in exactly the layout used by
+SharedMemoryOutputConnector::Write() in the ReflexConditioningSignalProcessing module (see
+app/src/custom/ReflexConditioningSignalProcessing and the docstring of Operator.ReadMM() in
+app/gui/epocs.py):
+    1. four native unsigned longs: SampleBlock counter, number of channels, number of
+       samples per block, number of State variables
+    2. the signal, as native doubles, channel by channel, in microvolts
+    3. the State variable values, as native doubles
+    4. the space-delimited State variable names, followed by a newline and a null terminator
+As in the C++ original, the names are written once when the file is initialized, the counter
+is reset to 0 at the start of the run, and the counter is incremented only after the rest of
+each block has been written.
+
+Like the TrapFilter, the signal in each block is the most recently completed epoch of the
+trapped channels (LookBack before to LookForward after a rising edge on the trigger channel),
+and TrialsCompleted is incremented on the block in which each epoch completes.  Samples
+can come from either of two sources:
+
+    --file=XXX.dat   replay a BCI2000 .dat file, such as those in data/sample.  The file's own
+                     SamplingRate, SampleBlockSize, ChannelsToTrap, TriggerChannel,
+                     TriggerThreshold, LookBack and LookForward are used unless overridden on
+                     the command line.  Other State variables are replayed from the file.
+                     (NB: unlike ReflexConditioningSignalProcessing, this does not apply the
+                     IIRBandpass filter before trapping: only the mean of each trapped channel
+                     is subtracted, to remove the amplifier's DC offset.)
+
+    --synthetic      generate background EMG noise on two channels, with a trigger every
+                     --interval seconds and an M-wave and H-reflex after each one.
+
+Other options:
+
+    --mmap=XXX       path to the memory-mapped file (default: ../prog/epocs.mmap relative to
+                     this file, which is where the EPOCS GUI expects it)
+    --speed=N        play back at N times real time (default 1); 0 means as fast as possible
+    --fs=N           sampling rate in Hz (synthetic mode only: default 3200)
+    --sbs=N          samples per block (default: the file's SampleBlockSize, or 128)
+    --lookback=N     msec before each trigger (default: the file's setting, or 100)
+    --lookforward=N  msec after each trigger (default: the file's setting, or 500)
+    --interval=N     seconds between synthetic triggers (default 5)
+    --duration=N     stop after N seconds of signal (synthetic default 60; replay default: end of file)
+    --loop           start again from the beginning when the file ends
+    --quiet          do not print progress
+
+For example, to load-test at the settings of custom/SampleAt6400Hz.bat at 4x speed:
+    python SharedMemoryProducer.py --synthetic --fs=6400 --sbs=256 --speed=4
+"""
+
+import os, re, sys, time, mmap, struct, inspect
+import numpy
+
+TOOLSDIR = os.path.dirname( os.path.realpath( inspect.getfile( inspect.currentframe() ) ) )
+DEFAULT_MMFILE = os.path.abspath( os.path.join( TOOLSDIR, '../prog/epocs.mmap' ) )
+
+# the State variables that the EPOCS GUI reads, in the order in which ReflexConditioningSignalProcessing usually defines them
+SYNTHETIC_STATES = 'Running SourceTime StimulusTime BackgroundFeedbackValue BackgroundGreen EnableTrigger TriggerExpressionSatisfied CurrentAmplitude NeedsUpdating TrialsCompleted ResponseFeedbackValue ReferenceFeedbackValue ResponseGreen SuccessfulTrials ProcessCompleted'.split()
+
+class SharedMemoryWriter( object ):
+    """
+    Owns the memory-mapped file and writes SampleBlocks into it in the
+    SharedMemoryOutputConnector layout.
+    """
+    headerFormat = '@LLLL'
+    counterFormat = '@L'
+
+    def __init__( self, filename, nChannels, nElements, stateNames ):
+        self.filename = filename
+        self.nChannels = int( nChannels )
+        self.nElements = int( nElements )
+        self.stateNames = list( stateNames )
+        self.nStates = len( self.stateNames )
+        names = ( ' '.join( self.stateNames ) + '\n\0' ).encode( 'ascii' )
+        headerSize = struct.calcsize( self.headerFormat )
+        itemSize = numpy.dtype( numpy.float64 ).itemsize
+        self.signalOffset = headerSize
+        self.statesOffset = self.signalOffset + itemSize * self.nChannels * self.nElements
+        self.namesOffset = self.statesOffset + itemSize * self.nStates
+        self.size = self.namesOffset + len( names )
+        directory = os.path.dirname( os.path.abspath( filename ) )
+        if not os.path.isdir( directory ): os.makedirs( directory )
+        self.file = open( filename, 'w+b' )
+        self.file.write( b'\0' * self.size )
+        self.file.flush()
+        self.mm = mmap.mmap( self.file.fileno(), self.size, access=mmap.ACCESS_WRITE )
+        self.signal = numpy.ndarray( ( self.nChannels, self.nElements ), dtype=numpy.float64, buffer=self.mm, offset=self.signalOffset )
+        self.states = numpy.ndarray( ( self.nStates, ), dtype=numpy.float64, buffer=self.mm, offset=self.statesOffset )
+        self.mm[ :headerSize ] = struct.pack( self.headerFormat, 0, self.nChannels, self.nElements, self.nStates )
+        self.mm[ self.namesOffset:self.size ] = names
+        self.counter = 0
+
+    def StartRun( self ):
+        self.counter = 0
+        self.mm[ :struct.calcsize( self.counterFormat ) ] = struct.pack( self.counterFormat, 0 )
+
+    def Write( self, signal, states ):
+        """
+        Write one SampleBlock: <signal> is a channels-by-samples array in microvolts and
+        <states> is a sequence of values in the order of self.stateNames.  The counter is
+        incremented last, so that a reader never sees the new count before the new data.
+        """
+        self.signal[ :, : ] = signal
+        self.states[ : ] = states
+        self.counter += 1
+        self.mm[ :struct.calcsize( self.counterFormat ) ] = struct.pack( self.counterFormat, self.counter )
+
+    def Close( self ):
+        self.signal = self.states = None
+        self.mm.close()
+        self.file.close()
+
+def ParseValue( text, units ):
+    """
+    Interpret a BCI2000 parameter value such as '500ms', '3200Hz' or '1.0V', returning
+    it in the base unit named by <units> ('s', 'Hz' or 'V').  Numbers without units are
+    returned unchanged.
+    """
+    m = re.match( r'^\s*([-+0-9.eE]+)\s*(.*?)\s*$', text )
+    if not m: raise ValueError( 'could not interpret %r' % text )
+    value, suffix = float( m.group( 1 ) ), m.group( 2 )
+    if not suffix: return value
+    prefixes = { '': 1.0, 'k': 1e3, 'm': 1e-3, 'u': 1e-6, 'mu': 1e-6, 'n': 1e-9 }
+    if not suffix.endswith( units ): raise ValueError( 'expected a value in %s, got %r' % ( units, text ) )
+    return value * prefixes[ suffix[ :-len( units ) ] ]
+
+class DatFile( object ):
+    """
+    A minimal reader for BCI2000 .dat files: signal (converted to microvolts using SourceChGain
+    and SourceChOffset), State variables, and the parameters needed for trial trapping.
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        raw = open( filename, 'rb' ).read()
+        firstLine = raw[ :raw.index( b'\n' ) ].decode( 'ascii' )
+        fields = dict( re.findall( r'(\w+)=\s*(\S+)', firstLine ) )
+        headerLength = int( fields[ 'HeaderLen' ] )
+        nChannels = int( fields[ 'SourceCh' ] )
+        stateVectorLength = int( fields[ 'StatevectorLen' ] )
+        dataFormat = fields.get( 'DataFormat', 'int16' )
+        header = raw[ :headerLength ].decode( 'latin-1' ).replace( '\r', '' ).split( '\n' )
+
+        self.stateDefinitions = []
+        self.params = {}
+        section = None
+        for line in header[ 1: ]:
+            line = line.strip()
+            if line.startswith( '[' ): section = line.strip( '[] ' ).lower(); continue
+            if not line: continue
+            if section == 'state vector definition':
+                name, length, value, byteLocation, bitLocation = line.split()[ :5 ]
+                self.stateDefinitions.append( ( name, int( length ), int( byteLocation ), int( bitLocation ) ) )
+            elif section == 'parameter definition':
+                definition = line.split( '//' )[ 0 ].split()
+                if len( definition ) < 3 or not definition[ 2 ].endswith( '=' ): continue
+                kind, name, values = definition[ 1 ], definition[ 2 ].rstrip( '=' ), definition[ 3: ]
+                if kind.endswith( 'list' ) and len( values ): values = values[ 1:int( values[ 0 ] ) + 1 ]
+                elif len( values ): values = values[ 0 ]
+                self.params[ name ] = values
+
+        dtype = numpy.dtype( { 'int16': '<i2', 'int32': '<i4', 'float32': '<f4' }[ dataFormat ] )
+        recordType = numpy.dtype( [ ( 'signal', dtype, ( nChannels, ) ), ( 'states', numpy.uint8, ( stateVectorLength, ) ) ] )
+        nSamples = ( len( raw ) - headerLength ) // recordType.itemsize
+        records = numpy.frombuffer( raw, dtype=recordType, count=nSamples, offset=headerLength )
+
+        gain = numpy.array( [ float( x ) for x in self.params.get( 'SourceChGain', [ 1 ] * nChannels ) ] )
+        offset = numpy.array( [ float( x ) for x in self.params.get( 'SourceChOffset', [ 0 ] * nChannels ) ] )
+        self.signal = ( ( records[ 'signal' ].astype( numpy.float64 ) - offset ) * gain ).T # channels by samples, microvolts
+        self.channelNames = self.params.get( 'ChannelNames', [] ) or [ str( i + 1 ) for i in range( nChannels ) ]
+        stateBytes = records[ 'states' ]
+        self.states = {}
+        for name, length, byteLocation, bitLocation in self.stateDefinitions:
+            value = numpy.zeros( nSamples, dtype=numpy.uint64 )
+            for i in range( ( bitLocation + length + 7 ) // 8 ):
+                value |= stateBytes[ :, byteLocation + i ].astype( numpy.uint64 ) << numpy.uint64( 8 * i )
+            self.states[ name ] = ( ( value >> numpy.uint64( bitLocation ) ) & numpy.uint64( ( 1 << length ) - 1 ) ).astype( numpy.float64 )
+        self.stateNames = [ name for name, length, byteLocation, bitLocation in self.stateDefinitions if not name.startswith( '__pad' ) ]
+
+    def ChannelIndex( self, entry ):
+        if entry in self.channelNames: return self.channelNames.index( entry )
+        return int( entry ) - 1
+
+    def Param( self, name, units, default ):
+        value = self.params.get( name, None )
+        if value in ( None, [] ): return default
+        return ParseValue( value, units )
+
+class TrialTrapper( object ):
+    """
+    Reproduces the trial-trapping logic of TrapFilter::Process(): a trigger is a rising
+    edge on the trigger channel at least <lookForward> samples after the previous trigger
+    (and not on the very first sample); the epoch completes, and TrialsCompleted is
+    incremented, <lookForward> - 1 samples after the trigger sample.
+    """
+    def __init__( self, trigger, threshold, lookBack, lookForward ):
+        above = numpy.asarray( trigger ) >= threshold
+        previous = numpy.concatenate( [ [ True ], above[ :-1 ] ] )
+        triggers = []
+        for sample in numpy.flatnonzero( above & ~previous ):
+            if not triggers or sample - triggers[ -1 ] >= lookForward: triggers.append( sample )
+        self.lookBack, self.lookForward = lookBack, lookForward
+        self.triggers = numpy.array( triggers, dtype=int )
+        self.completions = self.triggers + lookForward - 1
+
+    def Epoch( self, signal, trial ):
+        start = self.triggers[ trial ] - self.lookBack
+        stop = self.triggers[ trial ] + self.lookForward
+        epoch = numpy.zeros( ( signal.shape[ 0 ], stop - start ) )
+        available = signal[ :, max( start, 0 ):stop ]
+        epoch[ :, epoch.shape[ 1 ] - available.shape[ 1 ]: ] = available
+        return epoch
+
+def Synthesize( fs, duration, interval, lookBack, seed=None ):
+    """
+    Return a 3-channel (EMG1, EMG2, TRIG) signal in microvolts of the given <duration> in
+    seconds, with a 5V trigger pulse every <interval> seconds, each followed by a
+    biphasic M-wave at about 8ms and H-reflex at about 30ms on the EMG channels.
+    """
+    rng = numpy.random.RandomState( seed )
+    n = int( round( duration * fs ) )
+    t = numpy.arange( n ) / float( fs )
+    emg = rng.normal( 0.0, 8.0, size=( 2, n ) ) * ( 1.0 + 0.3 * numpy.sin( 2 * numpy.pi * 0.1 * t ) )
+    trig = numpy.zeros( n )
+    pulse = max( 1, int( 0.001 * fs ) )
+    def wave( center, width, amplitude ):
+        tt = numpy.arange( -3 * width, 3 * width, 1.0 / fs )
+        return amplitude * -numpy.sin( numpy.pi * tt / width ) * numpy.exp( -( tt / width ) ** 2 ), int( round( center * fs ) ) - len( tt ) // 2
+    first = max( lookBack + 0.5, 1.0 )
+    for onset in numpy.arange( first, duration - 0.6, interval ):
+        i = int( round( onset * fs ) )
+        trig[ i:i + pulse ] = 5e6
+        for channel, scale in enumerate( [ 1.0, 0.4 ] ):
+            for center, width, amplitude in [ ( 0.008, 0.0025, 300.0 ), ( 0.030, 0.004, rng.uniform( 100.0, 400.0 ) ) ]:
+                shape, shift = wave( center, width, amplitude * scale )
+                j = i + shift
+                if j >= 0 and j + len( shape ) <= n: emg[ channel, j:j + len( shape ) ] += shape
+    return numpy.vstack( [ emg, trig ] )
+
+def MeanRectified( epoch, start, stop ):
+    return float( numpy.mean( numpy.abs( epoch[ start:stop ] ) ) )
+
+def Play( signal, trapChannels, trapper, fs, sbs, writer, stateSource=None, speed=1.0, quiet=False ):
+    """
+    Stream <signal> (channels by samples, microvolts) into <writer>, one block of <sbs>
+    samples at a time, paced at <speed> times real time.  The signal in each block is the
+    latest completed epoch of the <trapChannels>.  State variables come from <stateSource>
+    (a dict of per-sample arrays, as in DatFile.states) where available; TrialsCompleted,
+    Running and, in the absence of <stateSource>, the feedback States are computed here.
+    """
+    nSamples = signal.shape[ 1 ]
+    nBlocks = nSamples // sbs
+    epochLength = trapper.lookBack + trapper.lookForward
+    epoch = numpy.zeros( ( len( trapChannels ), epochLength ) )
+    names = writer.stateNames
+    values = dict( ( name, 0.0 ) for name in names )
+    trapped = signal[ trapChannels, : ]
+    background = int( 0.2 * fs )
+    response = ( trapper.lookBack + int( 0.025 * fs ), trapper.lookBack + int( 0.035 * fs ) )
+    reference = ( trapper.lookBack + int( 0.005 * fs ), trapper.lookBack + int( 0.012 * fs ) )
+    trials = successes = 0
+    period = sbs / float( fs )
+    writer.StartRun()
+    started = time.time()
+    for block in range( nBlocks ):
+        first, last = block * sbs, ( block + 1 ) * sbs - 1
+        completed = numpy.flatnonzero( ( trapper.completions >= first ) & ( trapper.completions <= last ) )
+        if stateSource != None:
+            for name in names:
+                if name in stateSource: values[ name ] = stateSource[ name ][ first ]
+        else:
+            values[ 'BackgroundFeedbackValue' ] = MeanRectified( trapped[ 0 ], max( 0, last + 1 - background ), last + 1 )
+            values[ 'BackgroundGreen' ] = 1.0
+        for trial in completed:
+            epoch = trapper.Epoch( trapped, trial )
+            trials += 1
+            if stateSource == None:
+                values[ 'ResponseFeedbackValue' ] = MeanRectified( epoch[ 0 ], *response )
+                values[ 'ReferenceFeedbackValue' ] = MeanRectified( epoch[ 0 ], *reference )
+                values[ 'ResponseGreen' ] = float( values[ 'ResponseFeedbackValue' ] > 30.0 )
+                successes += int( values[ 'ResponseGreen' ] )
+                values[ 'SuccessfulTrials' ] = successes
+        values[ 'TrialsCompleted' ] = trials
+        values[ 'Running' ] = 1.0
+        if speed > 0:
+            delay = started + ( block + 1 ) * period / speed - time.time()
+            if delay > 0: time.sleep( delay )
+        writer.Write( epoch, [ values[ name ] for name in names ] )
+        if not quiet and ( block + 1 ) % max( 1, int( 5.0 / period ) ) == 0:
+            elapsed = time.time() - started
+            sys.stdout.write( '%d blocks, %d trials, %.1f s of signal in %.1f s (%.2fx)\n' % ( block + 1, trials, ( block + 1 ) * period, elapsed, ( block + 1 ) * period / max( elapsed, 1e-9 ) ) )
+            sys.stdout.flush()
+    return nBlocks, trials
+
+if __name__ == '__main__':
+
+    import getopt
+    opts, args = getopt.getopt( sys.argv[ 1: ], '', [ 'file=', 'synthetic', 'mmap=', 'speed=', 'fs=', 'sbs=', 'lookback=', 'lookforward=', 'interval=', 'duration=', 'loop', 'quiet', 'help' ] )
+    opts = dict( opts )
+    if '--help' in opts or ( '--file' not in opts and '--synthetic' not in opts ):
+        sys.stdout.write( __doc__ ); sys.exit( 0 )
+
+    speed = float( opts.get( '--speed', 1 ) )
+    quiet = '--quiet' in opts
+    mmfilename = opts.get( '--mmap', DEFAULT_MMFILE )
+
+    if '--file' in opts:
+        dat = DatFile( opts[ '--file' ] )
+        fs = float( opts.get( '--fs', dat.Param( 'SamplingRate', 'Hz', 3200.0 ) ) )
+        sbs = int( opts.get( '--sbs', dat.Param( 'SampleBlockSize', '', 128 ) ) )
+        lookBack = float( opts[ '--lookback' ] ) / 1000.0 if '--lookback' in opts else dat.Param( 'LookBack', 's', 0.1 )
+        lookForward = float( opts[ '--lookforward' ] ) / 1000.0 if '--lookforward' in opts else dat.Param( 'LookForward', 's', 0.5 )
+        signal = dat.signal
+        if '--duration' in opts: signal = signal[ :, :int( float( opts[ '--duration' ] ) * fs ) ]
+        trapChannels = [ dat.ChannelIndex( entry ) for entry in ( dat.params.get( 'ChannelsToTrap' ) or [ '1', '2' ] ) ]
+        signal = signal.copy()
+        signal[ trapChannels, : ] -= signal[ trapChannels, : ].mean( axis=1 )[ :, None ]
+        trigger = signal[ dat.ChannelIndex( dat.params.get( 'TriggerChannel', '3' ) ) ] * 1e-6 # volts
+        threshold = dat.Param( 'TriggerThreshold', 'V', 1.0 )
+        stateNames, stateSource = dat.stateNames, dat.states
+    else:
+        fs = float( opts.get( '--fs', 3200 ) )
+        sbs = int( opts.get( '--sbs', 128 ) )
+        lookBack = float( opts.get( '--lookback', 100 ) ) / 1000.0
+        lookForward = float( opts.get( '--lookforward', 500 ) ) / 1000.0
+        signal = Synthesize( fs=fs, duration=float( opts.get( '--duration', 60 ) ), interval=float( opts.get( '--interval', 5 ) ), lookBack=lookBack )
+        trapChannels = [ 0, 1 ]
+        trigger = signal[ 2 ] * 1e-6
+        threshold = 1.0
+        stateNames, stateSource = SYNTHETIC_STATES, None
+
+    for name in [ 'Running', 'TrialsCompleted' ]:
+        if name not in stateNames: stateNames = stateNames + [ name ]
+    lookBackSamples = int( 0.5 + lookBack * fs )
+    lookForwardSamples = int( 0.5 + lookForward * fs )
+    trapper = TrialTrapper( trigger, threshold, lookBackSamples, lookForwardSamples )
+    writer = SharedMemoryWriter( mmfilename, len( trapChannels ), lookBackSamples + lookForwardSamples, stateNames )
+    if not quiet:
+        sys.stdout.write( 'writing %d-channel, %d-sample SampleBlocks to %s: %g Hz, %d samples per block, %d triggers, speed %s\n' % ( writer.nChannels, writer.nElements, mmfilename, fs, sbs, len( trapper.triggers ), speed or 'unlimited' ) )
+        sys.stdout.flush()
+    try:
+        while True:
+            Play( signal, trapChannels, trapper, fs, sbs, writer, stateSource=stateSource, speed=speed, quiet=quiet )
+            if '--loop' not in opts: break
+    except KeyboardInterrupt: pass
+    writer.Close()